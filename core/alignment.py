@@ -0,0 +1,94 @@
+import time
+
+import numpy as np
+
+"""
+Automatic detection of the rotation axis. A projection taken at angle a+180° is the mirror image of the projection at
+angle a, mirrored at the rotation axis. Flipping the opposite projection horizontally therefore turns it into a shifted
+copy of the first one. The shift is found by cross-correlating both projections along x in the Fourier domain (all rows
+at once) and refining the correlation peak to sub-pixel precision.
+"""
+
+
+def find_opposite_pairs(angles, pairs=4, tolerance=None):
+    """
+    Find pairs of projections that are 180° apart
+    :param angles: projection angles in degrees
+    :param pairs: maximum number of pairs, spread evenly over the first half turn
+    :param tolerance: maximum deviation from 180° in degrees (default: one angular step)
+    :return: list of tuples (index, opposite index)
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    if len(angles) < 2:
+        raise Exception("Not enough projections for axis detection")
+    if tolerance is None:
+        tolerance = np.max(np.abs(np.diff(angles)))
+
+    first = np.flatnonzero(angles < angles[0] + 180 - tolerance / 2)
+    result = []
+    for i in first[np.linspace(0, len(first) - 1, min(pairs, len(first))).astype(int)]:
+        dist = np.abs((angles - angles[i]) % 360 - 180)
+        j = int(np.argmin(dist))
+        if dist[j] <= tolerance / 2 and (int(i), j) not in result:
+            result.append((int(i), j))
+
+    if not result:
+        raise Exception("No projections 180° apart found, scan angle too small")
+    return result
+
+
+def _subpixel_peak(corr, k):
+    """
+    Refine position of a maximum by fitting a parabola through it and its neighbors
+    :param corr: 1D numpy array
+    :param k: index of maximum
+    :return: sub-pixel position of maximum
+    """
+    if k <= 0 or k >= len(corr) - 1:
+        return float(k)
+    left, center, right = corr[k - 1], corr[k], corr[k + 1]
+    denom = left - 2 * center + right
+    if denom == 0:
+        return float(k)
+    return k + 0.5 * (left - right) / denom
+
+
+def find_shift(pairs):
+    """
+    Find shift s with flipped(x) = proj(x + s) for pairs of projections and their horizontally flipped opposite projections.
+    The cross-power spectra of all rows and pairs are summed up, so a single inverse FFT yields the combined correlation
+    :param pairs: list of tuples (projection, opposite projection), 2D numpy arrays (rows, cols) of the same shape
+    :return: shift in pixels
+    """
+    w = pairs[0][0].shape[-1]
+    n = 2 * w # zero padding prevents wrap around
+    cross = None
+
+    for proj, opposite in pairs:
+        a = np.asarray(proj, dtype=np.float32)
+        b = np.asarray(opposite, dtype=np.float32)[:, ::-1]
+        a = a - np.mean(a, axis=1, keepdims=True)
+        b = b - np.mean(b, axis=1, keepdims=True)
+        spec = np.sum(np.fft.rfft(a, n=n, axis=1) * np.conj(np.fft.rfft(b, n=n, axis=1)), axis=0)
+        cross = spec if cross is None else cross + spec
+
+    corr = np.fft.fftshift(np.fft.irfft(cross, n=n)) # index w corresponds to shift 0
+    k = int(np.argmax(corr))
+    return _subpixel_peak(corr, k) - w
+
+
+def find_axis(projections, angles, pairs=4):
+    """
+    Find rotation axis in a projection stack
+    :param projections: numpy array in (rows, angles, cols) layout, may be a memory map
+    :param angles: projection angles in degrees
+    :param pairs: number of opposite projection pairs used
+    :return: column of the rotation axis (pixel centers at integer positions)
+    """
+    start = time.perf_counter()
+    indices = find_opposite_pairs(angles, pairs)
+    images = [(np.array(projections[:, i, :]), np.array(projections[:, j, :])) for i, j in indices]
+    shift = find_shift(images)
+    axis = float(shift + projections.shape[2] - 1) / 2
+    print("Rotation axis at column %f (%d pairs, %.2fs)" % (axis, len(indices), time.perf_counter() - start))
+    return axis
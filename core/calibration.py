@@ -0,0 +1,112 @@
+import multiprocessing
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+from core import fsimage, fsstack
+
+"""
+Master dark and flat frames for flat-field correction. The calibration captures are stored like the projections of a
+scan: <scan folder>/calib/dark/raw/<n>.rw2 and <scan folder>/calib/flat/raw/<n>.rw2, so they can be imported with
+fsimage.import_images. The master frames are full raw images and are cached in <scan folder>/cache/calib/<kind>.npy
+until the calibration captures or the decoding parameters change.
+"""
+
+path_calib = Path('calib')
+path_cache_calib = Path('cache') / Path('calib')
+
+
+def get_calib_path(path_str, kind):
+    """
+    Get folder of calibration captures
+    :param path_str: loaded scan folder path
+    :param kind: "dark" or "flat"
+    :return: folder path (contains raw/ like a scan folder)
+    """
+    return Path(path_str) / path_calib / Path(kind)
+
+
+def find_calib_frames(path_str, kind):
+    """
+    List calibration captures
+    :param path_str: loaded scan folder path
+    :param kind: "dark" or "flat"
+    :return: sorted list of capture indices
+    """
+    raw_dir = get_calib_path(path_str, kind) / fsimage.path_raw
+    if not raw_dir.is_dir():
+        return []
+    pattern = re.compile(r'(\d+)' + re.escape(fsimage.file_format_extension) + '$', re.IGNORECASE)
+    return sorted(int(m.group(1)) for m in (pattern.match(name) for name in os.listdir(str(raw_dir))) if m is not None)
+
+
+def _decode_frame(job):
+    """
+    Decode single calibration capture. Module level function, so it can be sent to worker processes
+    :param job: tuple (calibration folder path, position in stack, capture index, decode backend)
+    :return: tuple (position in stack, numpy array)
+    """
+    calib_path, k, i, backend = job
+    return k, fsimage.load_projection(calib_path, i, cache_limit=0, backend=backend)
+
+
+def _combine_frames(path_str, kind, frames, method, backend, workers, band):
+    """
+    Decode calibration captures in parallel and combine them into a master frame without holding all captures in memory
+    """
+    calib_path = str(get_calib_path(path_str, kind))
+    jobs = [(calib_path, k, i, backend) for k, i in enumerate(frames)]
+    tmp_path = Path(path_str) / path_cache_calib / Path(kind + '_frames.npy')
+
+    acc = None
+    with multiprocessing.Pool(workers) as pool:
+        for k, frame in pool.imap_unordered(_decode_frame, jobs):
+            if acc is None:
+                if method == "mean":
+                    acc = np.zeros(frame.shape, dtype=np.float64)
+                else:
+                    # The median needs all values of a pixel, so the frames are collected on disk instead of in memory
+                    tmp_path.parent.mkdir(parents=True, exist_ok=True)
+                    acc = np.lib.format.open_memmap(str(tmp_path), mode='w+', dtype=frame.dtype, shape=(len(frames),) + frame.shape)
+            if method == "mean":
+                acc += frame
+            else:
+                acc[k] = frame
+
+    if method == "mean":
+        return (acc / len(frames)).astype(np.float32)
+
+    # Median over bands of rows, so only one band of all frames is in memory at once
+    master = np.empty(acc.shape[1:], dtype=np.float32)
+    for r in range(0, acc.shape[1], band):
+        master[r:r+band] = np.median(acc[:, r:r+band], axis=0)
+    del acc
+    os.remove(str(tmp_path))
+    return master
+
+
+def build_master(path_str, kind, method="median", backend="postprocess", workers=None, band=64):
+    """
+    Build master frame from calibration captures or load it from the cache
+    :param path_str: loaded scan folder path
+    :param kind: "dark" or "flat"
+    :param method: "median" or "mean"
+    :param backend: raw decoder (see fsimage.decode_backends), must be the same as for the projections
+    :param workers: number of decoding processes (default: number of CPUs)
+    :param band: number of rows combined at once by the median
+    :return: path of master frame file
+    """
+    frames = find_calib_frames(path_str, kind)
+    if not frames:
+        raise FileNotFoundError("No %s frames found in %s" % (kind, get_calib_path(path_str, kind)))
+
+    raw_files = [fsimage.get_raw_path(get_calib_path(path_str, kind), i) for i in frames]
+    key = {'method': method, 'backend': backend, 'files': fsstack.file_signature(raw_files)}
+    if backend == 'postprocess':
+        key['params'] = {k: str(v) for k, v in fsimage.raw_params.items()}
+
+    master_path = Path(path_str) / path_cache_calib / Path(kind + '.npy')
+    fsstack.load_cached(master_path, key, lambda out_path: _combine_frames(path_str, kind, frames, method, backend, workers, band), layout='rows, cols')
+    return master_path
@@ -0,0 +1,177 @@
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+"""
+Feldkamp-Davis-Kress (FDK) cone beam reconstruction on the CPU. The geometry matches the ASTRA cone geometry used by
+reconstruction.ReconAstra3DCone: the virtual detector passes through the rotation axis (detector pixels have the size of
+a voxel), the source is source_dist pixels away from the axis and the detector is moved by -shift pixels along its
+columns (astra.geom_postalignment). The volume has the layout (slices, rows, cols) like astra.create_vol_geom(w, w, h)
+or covers a window (minx, maxx, miny, maxy, minz, maxz) like the extended form of astra.create_vol_geom.
+Projections are weighted and ramp filtered with a batched FFT, stored in a temporary memory mapped file and
+backprojected in slabs of slices by a pool of worker processes, which read the filtered projections from that file.
+"""
+
+
+def get_detector_coords(h, w, shift=0.0):
+    """
+    Physical coordinates of the detector pixel centers (in pixels, relative to the point opposite the source)
+    :param h: number of detector rows
+    :param w: number of detector columns
+    :param shift: axis shift in pixels (see ProcessingParameters.get_shift_x)
+    :return: tuple (v coordinates of rows, u coordinates of cols)
+    """
+    return np.arange(h) - (h - 1) / 2, np.arange(w) - (w - 1) / 2 - shift
+
+
+def get_ramp_filter(w, pad=None):
+    """
+    Frequency response of the discrete Ram-Lak filter for unit pixel spacing. Created from the spatial kernel, so the
+    DC component is correct for finite detectors
+    :param w: number of detector columns
+    :param pad: FFT length (default: next power of two >= 2w)
+    :return: float32 numpy array of rfft frequencies
+    """
+    if pad is None:
+        pad = 1 << int(np.ceil(np.log2(2 * w)))
+    n = np.concatenate((np.arange(0, pad // 2 + 1), np.arange(-(pad // 2) + 1, 0)))
+    kernel = np.zeros(pad, dtype=np.float64)
+    kernel[0] = 0.25
+    odd = n % 2 == 1
+    kernel[odd] = -1.0 / (np.pi * n[odd]) ** 2
+    return np.real(np.fft.rfft(kernel)).astype(np.float32)
+
+
+def filter_projections(projections, source_dist, shift=0.0, out=None, chunk=8):
+    """
+    Apply cosine weighting and ramp filter to all rows of all projections
+    :param projections: numpy array in (rows, angles, cols) layout
+    :param source_dist: distance of the source from the rotation axis in pixels
+    :param shift: axis shift in pixels
+    :param out: output array of the same shape (e.g. memory map), a new array is allocated if None
+    :param chunk: number of detector rows filtered at once
+    :return: filtered float32 numpy array in (rows, angles, cols) layout
+    """
+    h, num, w = projections.shape
+    if out is None:
+        out = np.empty(projections.shape, dtype=np.float32)
+
+    v, u = get_detector_coords(h, w, shift)
+    ramp = get_ramp_filter(w)
+    pad = (len(ramp) - 1) * 2
+
+    for start in range(0, h, chunk):
+        rows = np.array(projections[start:start+chunk], dtype=np.float32)
+        weight = source_dist / np.sqrt(source_dist ** 2 + u[None, :] ** 2 + v[start:start+chunk, None] ** 2)
+        rows *= weight[:, None, :].astype(np.float32)
+        spectrum = np.fft.rfft(rows, n=pad, axis=2)
+        spectrum *= ramp
+        out[start:start+chunk] = np.fft.irfft(spectrum, n=pad, axis=2)[..., :w]
+
+    return out
+
+
+def _backproject_slab(job):
+    """
+    Backproject filtered projections into a slab of slices. Module level function, so it can be sent to worker processes
+    :param job: tuple (path of filtered projections (.npy), first slice, last slice + 1, angles in radians, source distance, axis shift,
+                volume size (slices, rows, cols), volume window (minx, maxx, miny, maxy, minz, maxz))
+    :return: tuple (first slice, float32 numpy array of shape (slices in slab, rows, cols))
+    """
+    path_str, z0, z1, angles, source_dist, shift, vol_shape, window = job
+    filtered = np.load(path_str, mmap_mode='r')
+    h, num, w = filtered.shape
+    nz, ny, nx = vol_shape
+    minx, maxx, miny, maxy, minz, maxz = window
+
+    # Voxel centers
+    z = (minz + (np.arange(z0, z1) + 0.5) * (maxz - minz) / nz).astype(np.float32)[:, None, None]
+    y = (miny + (np.arange(ny) + 0.5) * (maxy - miny) / ny).astype(np.float32)[:, None]
+    x = (minx + (np.arange(nx) + 0.5) * (maxx - minx) / nx).astype(np.float32)[None, :]
+    slab = np.zeros((z1 - z0, ny, nx), dtype=np.float32)
+
+    for i, angle in enumerate(angles):
+        proj = np.array(filtered[:, i, :]).ravel()
+        cos, sin = np.float32(np.cos(angle)), np.float32(np.sin(angle))
+        t = x * cos + y * sin # along detector columns
+        r = x * sin - y * cos # towards the source
+        mag = source_dist / (source_dist - r)
+
+        col = t * mag + (w - 1) / 2 + shift
+        row = z * mag + (h - 1) / 2 # (slices, rows, cols)
+
+        # Bilinear interpolation, samples outside the detector are zero
+        c0 = np.floor(col)
+        r0 = np.floor(row)
+        fc = col - c0
+        fr = row - r0
+        c0 = c0.astype(np.int64)
+        r0 = r0.astype(np.int64)
+
+        value = np.zeros(slab.shape, dtype=np.float32)
+        for dr, wr in ((0, 1 - fr), (1, fr)):
+            rr = r0 + dr
+            valid_r = (rr >= 0) & (rr < h)
+            for dc, wc in ((0, 1 - fc), (1, fc)):
+                cc = c0 + dc
+                valid = valid_r & ((cc >= 0) & (cc < w))
+                idx = np.clip(rr, 0, h - 1) * w + np.clip(cc, 0, w - 1)
+                value += np.where(valid, wr * wc, 0) * proj[idx]
+
+        slab += value * (mag * mag)
+
+    # Angular integration, valid for full turns and half turns
+    slab *= np.pi / len(angles)
+    return z0, slab
+
+
+def reconstruct(projections, angles, source_dist, shift=0.0, workers=None, slab_size=8, out=None, tmp_dir=None, vol_shape=None, window=None):
+    """
+    FDK reconstruction
+    :param projections: numpy array in (rows, angles, cols) layout
+    :param angles: projection angles in radians
+    :param source_dist: distance of the source from the rotation axis in pixels
+    :param shift: axis shift in pixels (see ProcessingParameters.get_shift_x)
+    :param workers: number of worker processes (default: number of CPUs)
+    :param slab_size: number of slices backprojected per job
+    :param out: output array of shape vol_shape (e.g. memory map), a new array is allocated if None
+    :param tmp_dir: folder for the temporary file of filtered projections (default: system temp folder)
+    :param vol_shape: volume size (slices, rows, cols) (default: (rows, cols, cols) of the projections)
+    :param window: region covered by the volume (minx, maxx, miny, maxy, minz, maxz) in pixels relative to the center (default: full field of view)
+    :return: float32 numpy array in (slices, rows, cols) layout
+    """
+    h, num, w = projections.shape
+    if vol_shape is None:
+        vol_shape = (h, w, w)
+    if window is None:
+        window = (-w / 2, w / 2, -w / 2, w / 2, -h / 2, h / 2)
+    vol_shape = tuple(int(n) for n in vol_shape)
+    window = tuple(float(v) for v in window)
+    if out is None:
+        out = np.zeros(vol_shape, dtype=np.float32)
+
+    if tmp_dir is not None:
+        Path(tmp_dir).mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        filtered_path = str(Path(tmp) / Path("filtered.npy"))
+        start = time.perf_counter()
+        filtered = np.lib.format.open_memmap(filtered_path, mode='w+', dtype=np.float32, shape=projections.shape)
+        filter_projections(projections, source_dist, shift, out=filtered)
+        filtered.flush()
+        del filtered
+        print("Filtered projections in %fs" % (time.perf_counter() - start))
+
+        start = time.perf_counter()
+        angles = [float(a) for a in angles]
+        jobs = [(filtered_path, z0, min(z0 + slab_size, vol_shape[0]), angles, float(source_dist), float(shift), vol_shape, window)
+                for z0 in range(0, vol_shape[0], slab_size)]
+        with multiprocessing.Pool(workers) as pool:
+            for z0, slab in pool.imap_unordered(_backproject_slab, jobs):
+                out[z0:z0 + slab.shape[0]] = slab
+        print("Backprojected %d slices in %fs" % (vol_shape[0], time.perf_counter() - start))
+
+    return out
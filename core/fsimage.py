@@ -1,3 +1,10 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
 import rawpy
 from pathlib import Path
 import re
@@ -7,6 +14,7 @@ from matplotlib import pyplot
 # Default image folder names
 path_raw = Path('raw')
 path_projections = Path('projections')
+path_cache_decoded = Path('cache') / Path('decoded')
 
 """
 Functions for abstracting import and conversion of images files.
@@ -17,6 +25,23 @@ https://www.libraw.org/supported-cameras (accessed 22.08.2020)
 file_format_extension = ".rw2" # CHANGE FILE FORMAT HERE
 
 
+# Parameters for converting raw images with as little processing as possible
+# Disable all parameters that look like they might do things on their own: See https://letmaik.github.io/rawpy/api/rawpy.Params.html (accessed 03.06.2020)
+raw_params = dict(use_camera_wb=False, use_auto_wb=False, no_auto_scale=True, no_auto_bright=True, half_size=True,
+                  gamma=(1,1), user_wb=[1.0, 1.0, 1.0, 1.0], bright=1.0, fbdd_noise_reduction=rawpy.FBDDNoiseReductionMode.Full,
+                  output_color=rawpy.ColorSpace.raw, output_bps=16, demosaic_algorithm=rawpy.DemosaicAlgorithm.LINEAR)
+
+
+def get_raw_path(path_str, i):
+    """
+    Construct path of a raw image inside the scan folder
+    :param path_str: loaded scan folder path
+    :param i: index of image
+    :return: path of raw image file
+    """
+    return Path(path_str) / path_raw / Path(str(i) + file_format_extension)
+
+
 def load_projection_raw_pana(path_str, i):
     """
     Convert RW2 file (panasonic raw image format) to RGB color space with as little processing as possible and extract green color channel
@@ -25,53 +50,360 @@ def load_projection_raw_pana(path_str, i):
     :return: numpy array of green color channel data
     """
     # List of supported cameras can be found here: https://www.libraw.org/supported-cameras (accessed 22.08.2020)
-    with rawpy.imread(str(Path(path_str) / path_raw / Path(str(i) + file_format_extension))) as raw:
-        # Disable all parameters that look like they might do things on their own: See https://letmaik.github.io/rawpy/api/rawpy.Params.html (accessed 03.06.2020)
-        rgb = raw.postprocess(use_camera_wb=False, use_auto_wb=False, no_auto_scale=True, no_auto_bright=True, half_size=True,
-                              gamma=(1,1), user_wb=[1.0, 1.0, 1.0, 1.0], bright=1.0, fbdd_noise_reduction=rawpy.FBDDNoiseReductionMode.Full,
-                              output_color=rawpy.ColorSpace.raw, output_bps=16, demosaic_algorithm=rawpy.DemosaicAlgorithm.LINEAR)
+    with rawpy.imread(str(get_raw_path(path_str, i))) as raw:
+        rgb = raw.postprocess(**raw_params)
         green = rgb[:, :, 1]
         return green
 
-def import_images(path_str, img_path, img_count):
+
+def bayer_green(mosaic, pattern, color_desc, black_levels, roi=None):
     """
-    Import consecutive RW2 files (panasonic raw image format) or jpg files into scan folder
+    Average the two green photosites of every 2x2 bayer quad. This results in the same half size geometry as
+    postprocess(half_size=True) without demosaicing and without allocating an RGB buffer
+    :param mosaic: 2D numpy array of raw sensor values
+    :param pattern: 2x2 array of color indices (rawpy raw_pattern)
+    :param color_desc: color description (rawpy color_desc, e.g. b'RGBG')
+    :param black_levels: black level of each color index
+    :param roi: optional region (x, y, x2, y2) in half size coordinates. Only the quads inside this region are processed
+    :return: numpy array of green color channel data (uint16)
+    """
+    greens = [(r, c) for r in range(2) for c in range(2) if chr(color_desc[pattern[r][c]]) == 'G']
+    if len(greens) != 2:
+        raise Exception("Unsupported color filter array: %s" % color_desc)
+
+    h = mosaic.shape[0] // 2
+    w = mosaic.shape[1] // 2
+    x, y, x2, y2 = (0, 0, w, h) if roi is None else clamp_region(roi, w, h)
+    (r0, c0), (r1, c1) = greens
+
+    # Strided views of both green photosites, no data is copied here. Every output pixel is a separate quad, so the region needs no margin
+    green0 = mosaic[2*y+r0:2*y2:2, 2*x+c0:2*x2:2]
+    green1 = mosaic[2*y+r1:2*y2:2, 2*x+c1:2*x2:2]
+
+    black = int(black_levels[pattern[r0][c0]]) + int(black_levels[pattern[r1][c1]])
+    green = np.add(green0, green1, dtype=np.int32)
+    green -= black
+    np.clip(green, 0, None, out=green)
+    green >>= 1 # LibRaw also mixes both greens with a shift in half size mode
+    return green.astype(np.uint16)
+
+
+def clamp_region(roi, w, h):
+    """
+    Limit region to image size
+    :param roi: region (x, y, x2, y2)
+    :param w: image width
+    :param h: image height
+    :return: clamped region (x, y, x2, y2)
+    """
+    x, y, x2, y2 = roi
+    return min(max(x, 0), w), min(max(y, 0), h), min(max(x2, 0), w), min(max(y2, 0), h)
+
+
+def load_projection_bayer_green(path_str, i, roi=None):
+    """
+    Extract green color channel of RW2 file (panasonic raw image format) directly from the bayer mosaic without demosaicing or noise reduction
     :param path_str: loaded scan folder path
-    :param img_path: path to first image of the sequence
-    :param img_count: number of images to be imported
+    :param i: index of image to be loaded
+    :param roi: optional region (x, y, x2, y2) to be extracted
+    :return: numpy array of green color channel data
+    """
+    with rawpy.imread(str(get_raw_path(path_str, i))) as raw:
+        return bayer_green(raw.raw_image_visible, raw.raw_pattern, raw.color_desc, raw.black_level_per_channel, roi)
+
+
+def load_projection_raw_pana_roi(path_str, i, roi=None):
     """
+    LibRaw can only process complete images, so the region is cut out after decoding
+    :param path_str: loaded scan folder path
+    :param i: index of image to be loaded
+    :param roi: optional region (x, y, x2, y2) to be extracted
+    :return: numpy array of green color channel data
+    """
+    green = load_projection_raw_pana(path_str, i)
+    if roi is None:
+        return green
+    x, y, x2, y2 = clamp_region(roi, green.shape[1], green.shape[0])
+    return green[y:y2, x:x2].copy() # copy, so that the full image can be freed
+
+# Available raw decoders. Selected per scan by ProcessingParameters.decode_backend
+decode_backends = {
+    'postprocess': load_projection_raw_pana_roi,
+    'bayer': load_projection_bayer_green
+}
+
+
+def compare_decode_backends(path_str, i, backends=('postprocess', 'bayer')):
+    """
+    Decode one projection with two backends and compare speed and pixel values
+    :param path_str: loaded scan folder path
+    :param i: index of image to be loaded
+    :param backends: names of the two backends to be compared
+    :return: dict containing decoding times in seconds and pixel difference statistics
+    """
+    results = {}
+    arrs = []
+    for name in backends:
+        start = time.perf_counter()
+        arrs.append(decode_backends[name](path_str, i))
+        results['time_' + name] = time.perf_counter() - start
+
+    if arrs[0].shape != arrs[1].shape:
+        raise Exception("Backends returned different shapes: %s, %s" % (arrs[0].shape, arrs[1].shape))
+
+    diff = arrs[0].astype(np.float32) - arrs[1].astype(np.float32)
+    results['diff_mean'] = float(np.mean(diff))
+    results['diff_abs_mean'] = float(np.mean(np.abs(diff)))
+    results['diff_abs_max'] = float(np.max(np.abs(diff)))
+    results['diff_rms'] = float(np.sqrt(np.mean(diff ** 2)))
+    return results
+
+
+def _cache_key(src, params):
+    """
+    Build the key that identifies a decoded image: source file size, modification time and decoding parameters
+    :param src: path of raw image file
+    :param params: dict of decoding parameters
+    :return: key as string
+    """
+    stat = src.stat()
+    return json.dumps({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'params': {k: str(v) for k, v in params.items()}}, sort_keys=True)
+
+
+def _cache_evict(cache_dir, limit):
+    """
+    Delete least recently used cache entries until the cache is smaller than limit
+    :param cache_dir: cache folder path
+    :param limit: maximum cache size in bytes
+    """
+    entries = []
+    for f in cache_dir.glob('*.npy'):
+        try:
+            stat = f.stat()
+            entries.append((stat.st_mtime, stat.st_size, f))
+        except FileNotFoundError:
+            pass # deleted by another worker
+
+    total = sum(e[1] for e in entries)
+    for mtime, size, f in sorted(entries, key=lambda e: e[0]):
+        if total <= limit:
+            break
+        try:
+            f.unlink()
+            f.with_suffix('.json').unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+
 
+def load_projection(path_str, i, cache_limit=2048, backend='postprocess', roi=None):
+    """
+    Load decoded projection from cache/decoded/<i>.npy inside the scan folder. If the cached data is missing or outdated the raw image is decoded and stored in the cache
+    :param path_str: loaded scan folder path
+    :param i: index of image to be loaded
+    :param cache_limit: maximum cache size in MB. If 0 the cache is not used
+    :param backend: name of raw decoder (see decode_backends)
+    :param roi: optional region (x, y, x2, y2) to be decoded. The 'bayer' backend only processes the data inside this region
+    :return: numpy array of green color channel data
+    """
+    decode = decode_backends[backend]
+    if not cache_limit:
+        return decode(path_str, i, roi)
+
+    cache_dir = Path(path_str) / path_cache_decoded
+    cache_name = str(i) if roi is None else '%d_%d_%d_%d_%d' % ((i,) + tuple(roi))
+    cache_file = cache_dir / Path(cache_name + '.npy')
+    key_file = cache_file.with_suffix('.json')
+    params = dict(raw_params) if backend == 'postprocess' else {}
+    params['backend'] = backend
+    key = _cache_key(get_raw_path(path_str, i), params)
+
+    try:
+        if key_file.read_text() == key:
+            arr = np.load(str(cache_file))
+            os.utime(str(cache_file)) # mark entry as recently used
+            return arr
+    except (OSError, ValueError):
+        pass # cache miss
+
+    arr = decode(path_str, i, roi)
+
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # Write to temporary file first, so that concurrent readers never see partially written data
+        tmp_file = cache_file.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            np.save(f, arr)
+        os.replace(str(tmp_file), str(cache_file))
+        key_file.write_text(key)
+        _cache_evict(cache_dir, cache_limit * 1024 * 1024)
+    except OSError as e:
+        print("Decode cache warning: " + str(e))
+
+    return arr
+
+def _take_consecutive(numbered, n, count):
+    """
+    Follow the camera numbering from a start number. Besides consecutive numbers only the folder rollover of the camera
+    is accepted (e.g. P1000999 is followed by P1010001, the next number is 9001 higher)
+    :param numbered: dict of image number -> path
+    :param n: first number
+    :param count: maximum number of images
+    :return: tuple (list of numbers, next expected number)
+    """
+    numbers = []
+    while len(numbers) < count:
+        if n in numbered:
+            numbers.append(n)
+            n += 1
+        elif n % 1000 == 0 and n + 9001 in numbered:
+            n += 9001
+        else:
+            break
+    return numbers, n
+
+
+def find_image_sequence(img_path, img_count):
+    """
+    Find consecutive camera images by listing the source folder once. Only the folder rollover of the camera numbering
+    is skipped, any other gap raises an exception listing the missing numbers.
+    If there are not enough images after the first one, the sequence continues at lower numbers only if the camera counter
+    rolled over (numbering restarts at 0 or 1 and these images were taken after the others). Lower numbered leftovers
+    of an earlier scan raise an exception instead of being appended
+    :param img_path: path to first image of the sequence
+    :param img_count: number of images in the sequence
+    :return: list of source paths
+    """
     path = Path(img_path)
     m = re.search(r'\d+', path.name) # extract number from file name
 
-    (Path(path_str) / path_raw).mkdir(parents=True, exist_ok=True)
-
     # Check if file extension is jpg or rw2. CHANGE IF OTHER FILE FORMATS ARE REQUIRED
     if m is None or (path.suffix.lower() != ".jpg" and path.suffix.lower() != file_format_extension):
         raise Exception("Invalid file format")
 
-    cnt_begin = m.group()
+    start = int(m.group())
+    pattern = re.compile(re.escape(path.name[:m.start()]) + r'(\d+)' + re.escape(path.name[m.end():]) + '$', re.IGNORECASE)
 
-    additional = 0
-    skipped = False
+    numbered = {}
+    for f in path.parent.iterdir():
+        fm = pattern.match(f.name)
+        if fm is not None and f.is_file():
+            numbered[int(fm.group(1))] = f
 
-    i = 0
-    while i < img_count:
-        src = path.parent / (path.stem.replace(cnt_begin, str(int(cnt_begin)+i+additional)) + str(path.suffix))
-        dest = Path(path_str) / path_raw / (str(i) + str(path.suffix))
+    numbers, n = _take_consecutive(numbered, start, img_count)
+    sequence = [numbered[k] for k in numbers]
 
-        print('----- %d/%d -----' % (i+1, img_count))
-        print(src)
-        print(dest)
-        try:
-            shutil.copy(src, dest)
-            skipped = False
-            i+=1
-        except Exception as e:
-            if skipped is True:
-                print("DIDN'T EXIST: FAILED")
-                print(e)
-                raise FileNotFoundError()
-            print("DIDN'T EXIST: SKIPPED")
-            skipped = True
-            additional += 9001
+    missing = img_count - len(sequence)
+    if missing > 0:
+        later = [k for k in numbered if k > n]
+        if later:
+            # Gap in the middle: the following images would get the angles of the missing ones
+            raise FileNotFoundError("Images %d to %d of the sequence starting at %s are missing"
+                                    % (n, min(later) - 1, path))
+
+        lowest = min(numbered)
+        before, n = _take_consecutive(numbered, lowest, missing) if lowest < start else ([], lowest)
+        if not before or not sequence:
+            raise FileNotFoundError("Found only %d of %d images starting at %s" % (len(sequence), img_count, path))
+
+        # Wrap around of camera numbering: the counter restarts at its lowest value and continues with newer images
+        wrapped = [numbered[k] for k in before]
+        last_time = sequence[-1].stat().st_mtime
+        if before[0] > 1 or any(f.stat().st_mtime < last_time for f in wrapped):
+            raise Exception("Found only %d of %d images starting at %s, the lower numbered images %s to %s are not a continuation "
+                            "of the sequence (left over from an earlier scan?)" % (len(sequence), img_count, path, wrapped[0].name, wrapped[-1].name))
+        if len(before) < missing:
+            if n < start:
+                raise FileNotFoundError("Images %d to %d of the sequence starting at %s are missing"
+                                        % (n, min(k for k in numbered if k > n) - 1, path))
+            raise FileNotFoundError("Found only %d of %d images starting at %s" % (len(sequence) + len(before), img_count, path))
+        sequence += wrapped
+
+    return sequence
+
+
+def _file_checksum(path):
+    """
+    Calculate SHA-1 checksum of file
+    :param path: file path
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _is_same_file(src, dest, verify):
+    """
+    Check if dest is an identical copy of src
+    :param src: source path
+    :param dest: destination path
+    :param verify: 'size' compares size and modification time, 'checksum' compares file contents
+    :return: bool if identical
+    """
+    try:
+        src_stat = src.stat()
+        dest_stat = dest.stat()
+    except FileNotFoundError:
+        return False
+
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+    if verify == 'checksum':
+        return _file_checksum(src) == _file_checksum(dest)
+    return abs(src_stat.st_mtime - dest_stat.st_mtime) < 2 # FAT file systems only store even seconds
+
+
+def _import_image(src, dest, verify):
+    """
+    Copy single image if it isn't imported yet and verify the copy
+    :param src: source path
+    :param dest: destination path
+    :param verify: 'size' or 'checksum'
+    :return: bool if the file was copied (False if it was already imported)
+    """
+    if _is_same_file(src, dest, verify):
+        return False
+
+    # Copy to temporary file first, so that an interrupted copy is never mistaken for an imported image
+    tmp = dest.with_suffix(dest.suffix + '.tmp')
+    shutil.copy2(src, tmp) # copy2 keeps the modification time, which is used to detect already imported files
+
+    if tmp.stat().st_size != src.stat().st_size or (verify == 'checksum' and _file_checksum(src) != _file_checksum(tmp)):
+        os.remove(str(tmp))
+        raise IOError("Verification of %s failed" % dest)
+
+    os.replace(str(tmp), str(dest))
+    return True
+
+
+def import_images(path_str, img_path, img_count, workers=4, verify='size'):
+    """
+    Import consecutive RW2 files (panasonic raw image format) or jpg files into scan folder.
+    Images that have already been imported are skipped, so an interrupted import can be resumed
+    :param path_str: loaded scan folder path
+    :param img_path: path to first image of the sequence
+    :param img_count: number of images to be imported
+    :param workers: number of concurrent copies
+    :param verify: 'size' compares size and modification time, 'checksum' compares file contents
+    """
+    sequence = find_image_sequence(img_path, img_count)
+
+    (Path(path_str) / path_raw).mkdir(parents=True, exist_ok=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for i, src in enumerate(sequence):
+            dest = Path(path_str) / path_raw / (str(i) + str(src.suffix))
+            futures[executor.submit(_import_image, src, dest, verify)] = (i, src, dest)
+
+        copied = 0
+        for done, future in enumerate(concurrent.futures.as_completed(futures)):
+            i, src, dest = futures[future]
+            if future.result():
+                copied += 1
+            print('----- %d/%d ----- %s -> %s' % (done + 1, img_count, src, dest))
+
+    print("Imported %d images, %d already existed" % (copied, img_count - copied))
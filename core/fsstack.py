@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from core import fsutil
+
+logger = logging.getLogger(__name__)
+
+"""
+Projection stack format: all projections of a scan are stored in a single memory mappable .npy file in the
+(rows, angles, cols) layout expected by ASTRA. A small json header next to it records shape, dtype, angles and the
+processing parameters that were used to create it.
+"""
+
+stack_ext = '.npy'
+header_ext = '.json'
+
+
+def get_stack_path(path_str, name):
+    """
+    Construct path of a projection stack inside the scan folder
+    :param path_str: loaded scan folder path
+    :param name: name of processed projections (ProcessingParameters.out_name)
+    :return: path of stack file
+    """
+    return Path(path_str) / Path('proj') / Path(name + stack_ext)
+
+
+def stack_exists(path):
+    """
+    Check if a completely written stack exists
+    :param path: path of stack file
+    :return: bool if stack and header exist
+    """
+    path = Path(path)
+    return path.is_file() and path.with_suffix(header_ext).is_file()
+
+
+def open_stack(path, mode='c'):
+    """
+    Open projection stack as memory map. No data is read until it is accessed
+    :param path: path of stack file
+    :param mode: numpy memmap mode. 'c' (copy on write) returns a writable array without modifying the file
+    :return: tuple (numpy memmap in (rows, angles, cols) layout, header dict)
+    """
+    path = Path(path)
+    with open(path.with_suffix(header_ext), 'r') as f:
+        header = json.load(f)
+    arr = np.load(str(path), mmap_mode=mode)
+    return arr, header
+
+
+class StackWriter:
+    """
+    Write projections one by one into a projection stack. Thread safe, projections may be written in any order.
+    The file is created as soon as the first projection (and therefore the image size) is known
+    """
+
+    def __init__(self, path, num, header=None, dtype=np.float32):
+        """
+        :param path: path of stack file
+        :param num: number of projections
+        :param header: dict of additional information stored in the header (e.g. angles, processing parameters)
+        :param dtype: data type of stored values
+        """
+        self.path = Path(path)
+        self.num = num
+        self.header = dict(header) if header else {}
+        self.dtype = np.dtype(dtype)
+        self.arr = None
+        self.lock = threading.Lock()
+
+    def write(self, i, proj):
+        """
+        Store a single projection
+        :param i: projection index
+        :param proj: 2D numpy array (rows, cols)
+        """
+        with self.lock:
+            if self.arr is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                # Remove old header first, so that an interrupted run never looks like a complete stack
+                if self.path.with_suffix(header_ext).is_file():
+                    os.remove(str(self.path.with_suffix(header_ext)))
+                shape = (proj.shape[0], self.num, proj.shape[1])
+                self.arr = np.lib.format.open_memmap(str(self.path), mode='w+', dtype=self.dtype, shape=shape)
+
+        self.arr[:, i, :] = proj
+
+    def close(self):
+        """
+        Flush data to disk and write header
+        """
+        if self.arr is None:
+            return
+
+        self.arr.flush()
+        self.header['shape'] = list(self.arr.shape)
+        self.header['dtype'] = self.dtype.str
+        self.header['layout'] = 'rows, angles, cols'
+        del self.arr
+        self.arr = None
+
+        with open(self.path.with_suffix(header_ext), 'w') as f:
+            json.dump(self.header, f, indent=4)
+
+
+def load_stack_downsample(path, downsample=None, mode="lanczos", chunk=16, out_path=None):
+    """
+    Load projection stack. Without downsampling the memory map is returned directly (zero copy)
+    :param path: path of stack file
+    :param downsample: downsampling factor
+    :param mode: downsampling mode (see fsutil.downsample_image)
+    :param chunk: number of projections binned at once
+    :param out_path: optional .npy file the downsampled projections are written to. The result is a memory map of this
+                     file, so the downsampled stack never has to fit into memory
+    :return: float32 numpy array in (rows, angles, cols) layout
+    """
+    arr, header = open_stack(path)
+    if not downsample or downsample == 1:
+        if arr.dtype == np.float32:
+            return arr
+        return arr.astype(np.float32)
+
+    def allocate(shape):
+        if out_path is None:
+            return np.empty(shape, dtype=np.float32)
+        return np.lib.format.open_memmap(str(out_path), mode='w+', dtype=np.float32, shape=shape)
+
+    if mode == "bin" and float(downsample).is_integer():
+        # Bin rows and cols of multiple projections at once
+        first = fsutil.bin_image(arr[:, 0:1, :], int(downsample), axes=(0, 2))
+        out = allocate((first.shape[0], arr.shape[1], first.shape[2]))
+        for a in range(0, arr.shape[1], chunk):
+            out[:, a:a+chunk, :] = fsutil.bin_image(arr[:, a:a+chunk, :], int(downsample), axes=(0, 2))
+        return out
+
+    first = fsutil.downsample_image(np.array(arr[:, 0, :], dtype=np.float32), downsample)
+    out = allocate((first.shape[0], arr.shape[1], first.shape[1]))
+    out[:, 0, :] = first
+    for i in range(1, arr.shape[1]):
+        out[:, i, :] = fsutil.downsample_image(np.array(arr[:, i, :], dtype=np.float32), downsample)
+    return out
+
+
+def file_signature(paths):
+    """
+    Describe files by name, size and modification time to detect changes
+    :param paths: list of file paths
+    :return: list of [name, size, mtime]
+    """
+    sig = []
+    for p in paths:
+        stat = os.stat(str(p))
+        sig.append([Path(p).name, stat.st_size, stat.st_mtime_ns])
+    return sig
+
+
+def load_cached(path, key, loader, layout='rows, angles, cols'):
+    """
+    Load stack from cache file if it was created with the same key, otherwise create it with loader and store it
+    :param path: path of cache stack file
+    :param key: json serializable description of the cached data and its source
+    :param loader: function creating the stack data. It is called with the path of the cache file (None if the cache
+                   can't be written) and may write the data directly into this file as memory map instead of returning
+                   an array held in memory
+    :param layout: description of the axes stored in the header
+    :return: float32 numpy array (memory map if loaded from or written directly to the cache)
+    """
+    path = Path(path)
+    key = json.loads(json.dumps(key)) # normalize (tuples -> lists) for comparison with stored key
+    if stack_exists(path):
+        arr, header = open_stack(path)
+        if header.get('source') == key:
+            logger.info("Using cached stack %s", path)
+            return arr
+
+    out_path = str(path)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Remove old header first, so that an interrupted run never looks like a complete stack
+        if path.with_suffix(header_ext).is_file():
+            os.remove(str(path.with_suffix(header_ext)))
+    except OSError as e:
+        logger.warning("Stack cache warning: %s", e)
+        out_path = None
+
+    arr = loader(out_path)
+    if out_path is None:
+        return arr
+
+    try:
+        mapped = isinstance(arr, np.memmap) and arr.filename is not None and Path(arr.filename).resolve() == path.resolve()
+        if mapped:
+            arr.flush()
+        else:
+            np.save(out_path, arr)
+        with open(path.with_suffix(header_ext), 'w') as f:
+            json.dump({'source': key, 'shape': list(arr.shape), 'dtype': arr.dtype.str, 'layout': layout}, f, indent=4)
+        if mapped:
+            # Reopen copy on write, so that changes of the caller never end up in the cache
+            del arr
+            arr, header = open_stack(path)
+    except OSError as e:
+        logger.warning("Stack cache warning: %s", e)
+
+    return arr
+
+
+def export_tiff(path, out_path_str):
+    """
+    Export projection stack as series of 16 bit TIFF files (<out_path>0000.tiff, <out_path>0001.tiff, ...)
+    :param path: path of stack file
+    :param out_path_str: output path
+    """
+    arr, header = open_stack(path, mode='r')
+    for i in range(arr.shape[1]):
+        fsutil.save_np_as_img(np.array(arr[:, i, :]), out_path_str, num=i)
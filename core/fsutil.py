@@ -1,8 +1,12 @@
+import collections
+import concurrent.futures
+import os
+import re
 from pathlib import Path
 
-import PIL
 import cv2
 import numpy as np
+import tifffile
 
 
 def construct_path_numbered(path_str, num):
@@ -21,11 +25,43 @@ def construct_path_numbered(path_str, num):
 
     return file_path
 
-def load_image_downsample(fp, downsample=None):
-    print(fp)
-    im = cv2.imread(str(fp), cv2.IMREAD_ANYDEPTH)
-
+def bin_image(arr, factor, axes=(0, 1)):
+    """
+    Downsample by averaging blocks of factor x factor pixels (vectorized, no interpolation).
+    If the size isn't a multiple of factor, the remaining pixels are cut off evenly at both sides, so the image center stays in place
+    :param arr: numpy array
+    :param factor: integer downsampling factor
+    :param axes: the two axes to be downsampled
+    :return: float32 numpy array
+    """
+    slc = [slice(None)] * arr.ndim
+    shape = []
+    for ax in range(arr.ndim):
+        if ax in axes:
+            n = arr.shape[ax] // factor
+            start = (arr.shape[ax] - n * factor) // 2
+            slc[ax] = slice(start, start + n * factor)
+            shape += [n, factor]
+        else:
+            shape.append(arr.shape[ax])
+
+    # Every binned axis is split into (n, factor), the factor axes are averaged
+    blocks = arr[tuple(slc)].reshape(shape)
+    mean_axes = tuple(ax + i + 1 for i, ax in enumerate(sorted(axes)))
+    return blocks.mean(axis=mean_axes, dtype=np.float32)
+
+def downsample_image(im, downsample=None, mode="lanczos"):
+    """
+    Scale image down
+    :param im: 2D numpy array
+    :param downsample: downsampling factor. If None the image is returned unchanged
+    :param mode: "lanczos" (Lanczos interpolation) or "bin" (block mean, only for integer factors)
+    :return: downsampled image
+    """
     if downsample:
+        if mode == "bin" and float(downsample).is_integer():
+            return bin_image(im, int(downsample))
+
         w = round(im.shape[1] / downsample)
         h = round(im.shape[0] / downsample)
         sz = (w, h)
@@ -35,14 +71,49 @@ def load_image_downsample(fp, downsample=None):
         #im = im.resize((round(w / downsample), round(h / downsample)), PIL.Image.ANTIALIAS)
     return im
 
+def load_image_downsample(fp, downsample=None, mode="lanczos"):
+    im = cv2.imread(str(fp), cv2.IMREAD_ANYDEPTH)
+    return downsample_image(im, downsample, mode)
+
+
+def to_uint16(np_arr, scale=1.0):
+    """
+    Convert values between 0 and 1 to 16bit uint without modifying the input array
+    :param np_arr: input numpy array
+    :param scale: factor applied before conversion
+    :return: uint16 numpy array
+    """
+    arr = np.multiply(np_arr, np.iinfo("uint16").max * scale) # allocates new array, input stays untouched
+    np.clip(arr, 0, np.iinfo("uint16").max, out=arr)
+    return arr.astype("uint16")
+
+def _slice_chunks(length, chunk):
+    """
+    Split range into chunks
+    :param length: length of range
+    :param chunk: chunk size
+    :return: list of (start, stop)
+    """
+    return [(start, min(start + chunk, length)) for start in range(0, length, chunk)]
+
+def _cut(np_arr, cutaxis, start, stop):
+    """
+    Get slices start to stop along cutaxis
+    """
+    slc = [slice(None)] * np_arr.ndim
+    slc[cutaxis] = slice(start, stop)
+    return np_arr[tuple(slc)]
 
-def save_np_as_img(np_arr, path_str, cutaxis=0, num=None):
+def save_np_as_img(np_arr, path_str, cutaxis=0, num=None, scale=1.0, workers=4, chunk=8):
     """
-    Convert numpy array (2D or 3D )to one/multiple PIL image(s) and save to disk
+    Convert numpy array (2D or 3D) to one/multiple 16 bit image(s) and save to disk. The input array is not modified
     :param np_arr: input numpy array
     :param path_str: output path
     :param cutaxis: direction of axis that is used to slice 3D data into 2D images
     :param num: number added to export name if only one image should be exported
+    :param scale: factor applied to the values before conversion
+    :param workers: number of threads writing slices of 3D data
+    :param chunk: number of slices converted at once by each thread (limits memory usage)
     """
     arrshape = np_arr.shape
 
@@ -52,35 +123,134 @@ def save_np_as_img(np_arr, path_str, cutaxis=0, num=None):
     if cutaxis not in range(0, 3):
         raise Exception("cutaxis out of bounds")
 
-    #convert to 16bit uint
-    np_arr *= np.iinfo("uint16").max
-    np_arr = np_arr.astype("uint16")
-
     if len(arrshape) == 2:
-        im = PIL.Image.fromarray(np_arr)
         file_path = construct_path_numbered(path_str, num)
-        #im.save(file_path)
-        cv2.imwrite(str(file_path), np_arr)
+        cv2.imwrite(str(file_path), to_uint16(np_arr, scale))
     elif len(arrshape) == 3:
-        for i in range(arrshape[cutaxis]):
-            slc = [slice(None)] * np_arr.ndim
-            slc[cutaxis] = i
-            im_arr = np_arr[tuple(slc)]
-            im = PIL.Image.fromarray(im_arr)
-            file_path = construct_path_numbered(path_str, num=i)
-            cv2.imwrite(str(file_path), im_arr)
-
-            #im.save(file_path)
-
+        def write(block):
+            start, stop = block
+            arr16 = to_uint16(_cut(np_arr, cutaxis, start, stop), scale)
+            for i in range(start, stop):
+                im_arr = np.take(arr16, i - start, axis=cutaxis)
+                cv2.imwrite(str(construct_path_numbered(path_str, num=i)), im_arr)
+
+        # cv2 releases the GIL while encoding, so the slices are written in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(write, _slice_chunks(arrshape[cutaxis], chunk)))
     else:
         raise Exception("Numpy Array doesn't have the right shape to be saved as an image")
 
-def load_img_as_np(path_str, stackaxis=0, num=None, downsample=None):
+def save_np_as_multipage(np_arr, path_str, cutaxis=0, scale=1.0, compression=None, chunk=8):
+    """
+    Save 3D numpy array as single multi-page 16 bit BigTIFF file. The input array is not modified
+    :param np_arr: input numpy array
+    :param path_str: output path
+    :param cutaxis: direction of axis that is used to slice 3D data into pages
+    :param scale: factor applied to the values before conversion
+    :param compression: tifffile compression (e.g. 'zlib') or None
+    :param chunk: number of slices converted at once (limits memory usage)
+    """
+    if len(np_arr.shape) != 3:
+        raise Exception("Numpy Array doesn't have the right shape to be saved as multi-page image")
+    if cutaxis not in range(0, 3):
+        raise Exception("cutaxis out of bounds")
+
+    path = Path(path_str)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with tifffile.TiffWriter(str(path), bigtiff=True) as tif:
+        for start, stop in _slice_chunks(np_arr.shape[cutaxis], chunk):
+            arr16 = to_uint16(_cut(np_arr, cutaxis, start, stop), scale)
+            for i in range(stop - start):
+                # Without shape metadata all pages are read back as one series
+                tif.write(np.take(arr16, i, axis=cutaxis), compression=compression, metadata=None)
+
+def find_numbered(path_str):
+    """
+    Find series of numbered files (<path>0000<suffix>, <path>0001<suffix>, ...) with a single directory listing
+    :param path_str: base path name
+    :return: list of paths of consecutively numbered files starting at 0
+    """
+    path = Path(path_str)
+    if not path.parent.is_dir():
+        return []
+
+    pattern = re.compile(re.escape(path.stem) + r'(\d{4})' + re.escape(path.suffix) + '$')
+    nums = set()
+    for name in os.listdir(str(path.parent)):
+        m = pattern.match(name)
+        if m is not None:
+            nums.add(int(m.group(1)))
+
+    c = 0
+    while c in nums:
+        c += 1
+    return [construct_path_numbered(path, num=i) for i in range(c)]
+
+
+def iter_img_stack(path_str, downsample=None, workers=4, prefetch=8, mode="lanczos"):
+    """
+    Load numbered images one after another while the following ones are decoded in the background
+    :param path_str: base path name of input files
+    :param downsample: downsampling factor
+    :param mode: downsampling mode (see downsample_image)
+    :param workers: number of decoding threads
+    :param prefetch: maximum number of images decoded in advance
+    :return: generator yielding tuples (index, numpy array)
+    """
+    files = find_numbered(path_str)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for i, fp in enumerate(files):
+            pending.append(executor.submit(load_image_downsample, fp, downsample, mode))
+            if len(pending) >= prefetch:
+                yield i - len(pending) + 1, pending.popleft().result()
+        while pending:
+            yield len(files) - len(pending), pending.popleft().result()
+
+
+def load_img_stack(path_str, stackaxis=0, downsample=None, workers=4, mode="lanczos"):
+    """
+    Load series of numbered images into a 3D array. cv2 releases the GIL while decoding, so the images are decoded in parallel threads
+    :param path_str: base path name of input files
+    :param stackaxis: direction of axis that is used to stack 2D images
+    :param downsample: downsampling factor
+    :param mode: downsampling mode (see downsample_image)
+    :param workers: number of decoding threads
+    :return: float32 numpy array
+    """
+    if stackaxis not in range(0, 3):
+        raise Exception("stackaxis out of bounds")
+
+    files = find_numbered(path_str)
+    if not files:
+        raise Exception("No 3D image array found with path %s" % path_str)
+
+    hero_arr = load_image_downsample(files[0], downsample, mode)
+    sz = [hero_arr.shape[0], hero_arr.shape[1]]
+    sz.insert(stackaxis, len(files))
+    raw_arr = np.empty(tuple(sz), dtype="float32")
+
+    def load(i):
+        slc = [slice(None)] * raw_arr.ndim
+        slc[stackaxis] = i
+        raw_arr[tuple(slc)] = hero_arr if i == 0 else load_image_downsample(files[i], downsample, mode)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() propagates exceptions of the workers
+        list(executor.map(load, range(len(files))))
+
+    return raw_arr
+
+
+def load_img_as_np(path_str, stackaxis=0, num=None, downsample=None, mode="lanczos"):
     """
     Load  PIL images from disk interpret them as 2D/3D data and convert to a numpy array
     :param path_str: path string of input files
     :param stackaxis: direction of axis that is used to stack 2D images to convert to a 3D array
     :param num: optional number of file to be loaded if only one should be imported instead of an array of images
+    :param downsample: downsampling factor
+    :param mode: downsampling mode (see downsample_image)
     :return: numpy array of loaded data
     """
     path = construct_path_numbered(path_str, num)
@@ -89,37 +259,11 @@ def load_img_as_np(path_str, stackaxis=0, num=None, downsample=None):
         raise Exception("stackaxis out of bounds")
 
     if path.is_file():
-        im = load_image_downsample(path, downsample)
+        im = load_image_downsample(path, downsample, mode)
         return np.array(im)
 
     elif path.parent.is_dir() and (num is None):
-        c = 0
-        while True:
-            test_path = construct_path_numbered(path, num=c)
-            if not test_path.is_file():
-                break
-            c += 1
-
-        hero_path = construct_path_numbered(path, num=0)
-        if not hero_path.is_file() or c <= 0:
-            raise Exception("No 3D image array found with path %s", path)
-
-        hero_im = load_image_downsample(hero_path, downsample)
-        hero_arr = np.array(hero_im)
-
-        sz = [hero_arr.shape[0], hero_arr.shape[1]]
-        sz.insert(stackaxis, c)
-
-        raw_arr = np.zeros(tuple(sz), dtype="float32")
-        for i in range(c):
-            slc = [slice(None)] * raw_arr.ndim
-            slc[stackaxis] = i
-            #construct_path_numbered(path, num=i)
-            im = load_image_downsample(construct_path_numbered(path, num=i), downsample)
-
-            raw_arr[tuple(slc)] = im
-
-        return raw_arr
+        return load_img_stack(path, stackaxis=stackaxis, downsample=downsample, mode=mode)
 
     else:
         raise Exception("Failed loading image array: No such filearray exists")
@@ -0,0 +1,212 @@
+import time
+
+import numpy as np
+import scipy.ndimage
+
+from core import fdk
+
+"""
+Synthetic test data for reconstruction providers: a 3D Shepp-Logan phantom made of ellipsoids, its exact cone beam
+projections in the geometry of reconstruction.ReconAstra3DCone (line integrals in voxel units) and its voxelized volume.
+"""
+
+# Modified 3D Shepp-Logan phantom: (density, center (x, y, z), semi-axes (x, y, z), rotation around z in degrees)
+# Positions and sizes are relative to half the volume size
+shepp_logan = [
+    (1.0, (0, 0, 0), (0.69, 0.92, 0.81), 0),
+    (-0.8, (0, -0.0184, 0), (0.6624, 0.874, 0.78), 0),
+    (-0.2, (0.22, 0, 0), (0.11, 0.31, 0.22), -18),
+    (-0.2, (-0.22, 0, 0), (0.16, 0.41, 0.28), 18),
+    (0.1, (0, 0.35, -0.15), (0.21, 0.25, 0.41), 0),
+    (0.1, (0, 0.1, 0.25), (0.046, 0.046, 0.05), 0),
+    (0.1, (0, -0.1, 0.25), (0.046, 0.046, 0.05), 0),
+    (0.1, (-0.08, -0.605, 0), (0.046, 0.023, 0.05), 0),
+    (0.1, (0, -0.606, 0), (0.023, 0.023, 0.02), 0),
+    (0.1, (0.06, -0.605, 0), (0.023, 0.046, 0.02), 0),
+]
+
+
+def _scale(ellipsoid, h, w):
+    """
+    Convert relative ellipsoid parameters to voxel units
+    :return: tuple (density, center, semi-axes, rotation matrix)
+    """
+    density, center, axes, phi = ellipsoid
+    half = np.array([w / 2, w / 2, h / 2])
+    phi = np.deg2rad(phi)
+    rot = np.array([[np.cos(phi), np.sin(phi), 0], [-np.sin(phi), np.cos(phi), 0], [0, 0, 1]]) # world -> ellipsoid frame
+    return density, np.array(center) * half, np.array(axes) * half, rot
+
+
+def project(ellipsoids, h, w, angles, source_dist, shift=0.0):
+    """
+    Calculate exact cone beam projections
+    :param ellipsoids: list of ellipsoids (see shepp_logan)
+    :param h: number of detector rows (and slices of the volume)
+    :param w: number of detector columns (and rows/cols of the volume)
+    :param angles: projection angles in radians
+    :param source_dist: distance of the source from the rotation axis in pixels
+    :param shift: axis shift in pixels (see ProcessingParameters.get_shift_x)
+    :return: float32 numpy array in (rows, angles, cols) layout
+    """
+    v, u = fdk.get_detector_coords(h, w, shift)
+    out = np.zeros((h, len(angles), w), dtype=np.float32)
+
+    for i, angle in enumerate(angles):
+        source = np.array([np.sin(angle), -np.cos(angle), 0]) * source_dist
+        det = (u[None, :, None] * np.array([np.cos(angle), np.sin(angle), 0]) +
+               v[:, None, None] * np.array([0, 0, 1.0])) # (rows, cols, 3)
+        direction = det - source
+        direction /= np.linalg.norm(direction, axis=2, keepdims=True)
+
+        for ellipsoid in ellipsoids:
+            density, center, axes, rot = _scale(ellipsoid, h, w)
+            p = (rot @ (source - center)) / axes
+            d = (direction @ rot.T) / axes
+            a = np.sum(d * d, axis=2)
+            b = 2 * np.sum(d * p, axis=2)
+            c = np.sum(p * p) - 1
+            disc = b * b - 4 * a * c
+            out[:, i, :] += density * np.sqrt(np.maximum(disc, 0)) / a
+
+    return out
+
+
+def voxelize(ellipsoids, h, w):
+    """
+    Sample phantom at the voxel centers
+    :param ellipsoids: list of ellipsoids (see shepp_logan)
+    :param h: number of slices
+    :param w: number of rows and cols
+    :return: float32 numpy array in (slices, rows, cols) layout
+    """
+    z, y, x = np.meshgrid(np.arange(h) - (h - 1) / 2, np.arange(w) - (w - 1) / 2, np.arange(w) - (w - 1) / 2, indexing='ij')
+    pos = np.stack((x, y, z), axis=-1)
+    vol = np.zeros((h, w, w), dtype=np.float32)
+    for ellipsoid in ellipsoids:
+        density, center, axes, rot = _scale(ellipsoid, h, w)
+        q = ((pos - center) @ rot.T) / axes
+        vol[np.sum(q * q, axis=-1) <= 1] += density
+    return vol
+
+
+def get_interior(ellipsoids, h, w, margin=2):
+    """
+    Find voxels inside the phantom that are at least margin voxels away from every density edge. Reconstructions are
+    band limited, so voxels next to edges mainly show partial volume errors of the sharp voxelized phantom
+    :param ellipsoids: list of ellipsoids (see shepp_logan)
+    :param h: number of slices
+    :param w: number of rows and cols
+    :param margin: distance from edges in voxels
+    :return: bool numpy array in (slices, rows, cols) layout
+    """
+    vol = voxelize(ellipsoids, h, w)
+    edges = np.zeros(vol.shape, dtype=bool)
+    for axis in range(3):
+        step = np.diff(vol, axis=axis) != 0
+        edges |= np.pad(step, [(0, 1) if a == axis else (0, 0) for a in range(3)])
+        edges |= np.pad(step, [(1, 0) if a == axis else (0, 0) for a in range(3)])
+    inside = voxelize(ellipsoids[:1], h, w) > 0
+    return inside & ~scipy.ndimage.binary_dilation(edges, iterations=margin)
+
+
+def benchmark(size=64, num=180, source_dist=None, shift=1.5, workers=None):
+    """
+    Reconstruct the phantom with fdk.reconstruct and, if available, with ASTRA (FDK_CUDA) and compare time and error
+    :param size: number of detector rows and cols
+    :param num: number of projections over a full turn
+    :param source_dist: distance of the source from the rotation axis in pixels (default: 8 * size, so the phantom fits on the detector)
+    :param shift: axis shift in pixels
+    :param workers: number of worker processes for fdk.reconstruct
+    :return: dict with time in seconds, root mean square error inside the phantom and root mean square error at least
+             2 voxels away from density edges (see get_interior) for every method
+    """
+    source_dist = source_dist if source_dist else 8 * size
+    angles = np.linspace(0, 2 * np.pi, num, endpoint=False)
+    projections = project(shepp_logan, size, size, angles, source_dist, shift)
+    truth = voxelize(shepp_logan, size, size)
+    inside = voxelize([(1.0, (0, 0, 0), (0.69, 0.92, 0.81), 0)], size, size) > 0
+    interior = get_interior(shepp_logan, size, size)
+
+    results = {}
+    start = time.perf_counter()
+    vol = fdk.reconstruct(projections, angles, source_dist, shift, workers=workers)
+    results['time_fdk_cpu'] = time.perf_counter() - start
+    results['rmse_fdk_cpu'] = float(np.sqrt(np.mean((vol[inside] - truth[inside]) ** 2)))
+    results['rmse_interior_fdk_cpu'] = float(np.sqrt(np.mean((vol[interior] - truth[interior]) ** 2)))
+
+    try:
+        import astra
+        if not astra.use_cuda():
+            raise Exception("no CUDA device")
+        proj_geom = astra.create_proj_geom('cone', 1, 1, size, size, angles, source_dist, 0)
+        proj_geom = astra.geom_postalignment(proj_geom, [-shift, 0])
+        vol_geom = astra.create_vol_geom(size, size, size)
+        start = time.perf_counter()
+        projections_id = astra.data3d.create('-proj3d', proj_geom, projections)
+        reconstruction_id = astra.data3d.create('-vol', vol_geom, data=0)
+        cfg = astra.astra_dict('FDK_CUDA')
+        cfg['ProjectionDataId'] = projections_id
+        cfg['ReconstructionDataId'] = reconstruction_id
+        algorithm_id = astra.algorithm.create(cfg)
+        astra.algorithm.run(algorithm_id)
+        vol_astra = astra.data3d.get(reconstruction_id)
+        astra.algorithm.delete(algorithm_id)
+        astra.data3d.delete([projections_id, reconstruction_id])
+        results['time_fdk_astra'] = time.perf_counter() - start
+        results['rmse_fdk_astra'] = float(np.sqrt(np.mean((vol_astra[inside] - truth[inside]) ** 2)))
+        results['rmse_interior_fdk_astra'] = float(np.sqrt(np.mean((vol_astra[interior] - truth[interior]) ** 2)))
+        results['rmse_cpu_astra'] = float(np.sqrt(np.mean((vol[inside] - vol_astra[inside]) ** 2)))
+    except Exception as e:
+        print("ASTRA comparison skipped: " + str(e))
+
+    return results
+
+
+def benchmark_multires(size=64, num=120, schedule=((4, 40), (2, 20), (1, 10)), iterations=(10, 25, 50, 100), algorithm="SIRT", workers=None):
+    """
+    Compare time to quality of multi-resolution and single level iterative reconstruction of the phantom.
+    Uses the row by row ASTRA CPU reconstruction, so the phantom is projected with a nearly parallel beam
+    :param size: number of detector rows and cols (divisible by all level factors)
+    :param num: number of projections over a full turn
+    :param schedule: multi-resolution levels ((downsample factor, iterations), ...) from coarse to fine
+    :param iterations: iteration counts of the single level runs
+    :param algorithm: ASTRA CPU algorithm ("SIRT" or "SART")
+    :param workers: number of worker processes
+    :return: dict with time in seconds and root mean square error inside the phantom of every run
+    """
+    import tempfile
+    from core import fsutil, reconstruction
+
+    source_dist = 1e6
+    angles = np.linspace(0, 2 * np.pi, num, endpoint=False)
+    projections = project(shepp_logan, size, size, angles, source_dist)
+    truth = voxelize(shepp_logan, size, size)
+    inside = voxelize([(1.0, (0, 0, 0), (0.69, 0.92, 0.81), 0)], size, size) > 0
+    rmse = lambda vol: float(np.sqrt(np.mean((vol[inside] - truth[inside]) ** 2)))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in iterations:
+            start = time.perf_counter()
+            vol = reconstruction.reconstruct_rows(projections, angles, 0.0, algorithm, count, tmp, workers)
+            results['time_single_%d' % count] = time.perf_counter() - start
+            results['rmse_single_%d' % count] = rmse(vol)
+            del vol
+
+        # Same steps as ReconstructionProvider.reconstruct_multires, with binned projections instead of scan data
+        start = time.perf_counter()
+        vol = None
+        prev_factor = None
+        for factor, count in schedule:
+            level = fsutil.bin_image(projections, factor, axes=(0, 2)) if factor > 1 else projections
+            init = None
+            if vol is not None:
+                init = reconstruction.upsample_volume(vol, (level.shape[0], level.shape[2], level.shape[2]), factor / prev_factor)
+            vol = reconstruction.reconstruct_rows(level, angles, 0.0, algorithm, count, tmp, workers, init=init)
+            prev_factor = factor
+        results['time_multires'] = time.perf_counter() - start
+        results['rmse_multires'] = rmse(vol)
+        del vol
+
+    return results
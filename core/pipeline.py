@@ -0,0 +1,165 @@
+import queue
+import threading
+import time
+
+"""
+Streaming pipeline for batch jobs: every stage runs in its own worker threads and passes its results to the next stage
+through a bounded queue. If a stage is slower than its predecessor, the queue fills up and the predecessor blocks
+(backpressure), so the number of items in flight and therefore the memory usage is limited independently of the number of items.
+"""
+
+# Marks the end of the item stream
+_end = object()
+
+
+class PipelineStage:
+    """
+    Single step of a pipeline including its throughput counters
+    """
+
+    def __init__(self, name, fun, workers=1):
+        """
+        :param name: descriptive name
+        :param fun: function that is called for every item. Its return value is passed on to the next stage
+        :param workers: number of worker threads
+        """
+        self.name = name
+        self.fun = fun
+        self.workers = max(1, int(workers))
+
+        self.count = 0
+        self.busy_time = 0.0 # time spent in fun, summed over all workers
+        self.wait_in_time = 0.0 # time spent waiting for input (stage is starved)
+        self.wait_out_time = 0.0 # time spent waiting for the next stage to accept a result (stage is blocked)
+        self.lock = threading.Lock()
+
+    def get_throughput(self):
+        """
+        Calculate throughput if the stage wouldn't have to wait for other stages
+        :return: items per second
+        """
+        if self.busy_time <= 0:
+            return 0.0
+        return self.count / (self.busy_time / self.workers)
+
+    def to_dict(self):
+        """
+        Export counters
+        :return: dict containing counters
+        """
+        return {'name': self.name, 'workers': self.workers, 'count': self.count, 'busy_time': self.busy_time,
+                'wait_in_time': self.wait_in_time, 'wait_out_time': self.wait_out_time, 'throughput': self.get_throughput()}
+
+
+class Pipeline:
+    """
+    Chain of stages connected by bounded queues
+    """
+
+    def __init__(self, maxsize=4):
+        """
+        :param maxsize: maximum number of items waiting in front of each stage
+        """
+        self.maxsize = max(1, int(maxsize))
+        self.stages = []
+
+    def add_stage(self, name, fun, workers=1):
+        """
+        Add new stage to the end of the pipeline
+        :param name: descriptive name
+        :param fun: function that is called for every item
+        :param workers: number of worker threads
+        :return: reference to self for chaining multiple calls together
+        """
+        self.stages.append(PipelineStage(name, fun, workers))
+        return self
+
+    def run(self, items):
+        """
+        Pass all items through the pipeline and block until all of them are done
+        :param items: iterable of input items for the first stage
+        :return: list of stage counters
+        """
+        queues = [queue.Queue(self.maxsize) for _ in self.stages]
+        errors = []
+        abort = threading.Event()
+
+        def worker(k, remaining):
+            stage = self.stages[k]
+            q_in = queues[k]
+            q_out = queues[k+1] if k+1 < len(queues) else None
+
+            while True:
+                start = time.perf_counter()
+                item = q_in.get()
+                waited = time.perf_counter() - start
+
+                if item is _end:
+                    with stage.lock:
+                        stage.wait_in_time += waited
+                        remaining[0] -= 1
+                        last = remaining[0] == 0
+                    # The last worker of a stage tells every worker of the next stage to stop
+                    if last and q_out is not None:
+                        for _ in range(self.stages[k+1].workers):
+                            q_out.put(_end)
+                    return
+
+                if abort.is_set():
+                    continue # drain queue after an error
+
+                try:
+                    start_busy = time.perf_counter()
+                    result = stage.fun(item)
+                    busy = time.perf_counter() - start_busy
+                except Exception as e:
+                    errors.append(e)
+                    abort.set()
+                    continue
+
+                start_out = time.perf_counter()
+                if q_out is not None:
+                    q_out.put(result)
+                blocked = time.perf_counter() - start_out
+
+                with stage.lock:
+                    stage.count += 1
+                    stage.busy_time += busy
+                    stage.wait_in_time += waited
+                    stage.wait_out_time += blocked
+
+        threads = []
+        for k, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            for _ in range(stage.workers):
+                t = threading.Thread(target=worker, args=(k, remaining), daemon=True)
+                t.start()
+                threads.append(t)
+
+        # Feed the first stage. put() blocks while the first queue is full
+        for item in items:
+            if abort.is_set():
+                break
+            queues[0].put(item)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_end)
+
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+
+        return [stage.to_dict() for stage in self.stages]
+
+    def print_stats(self):
+        """
+        Print counters of all stages. The stage with the lowest throughput is the bottleneck
+        """
+        for stage in self.stages:
+            print("Stage %s (%d workers): %d items, %.2f items/s, busy %.2fs, starved %.2fs, blocked %.2fs" %
+                  (stage.name, stage.workers, stage.count, stage.get_throughput(), stage.busy_time, stage.wait_in_time, stage.wait_out_time))
+
+        if self.stages:
+            bottleneck = min(self.stages, key=lambda s: s.get_throughput())
+            print("Bottleneck: %s" % bottleneck.name)
@@ -1,13 +1,29 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import time
+import tracemalloc
+
+import cv2
 import numpy as np
-from core import fsimage, scandata, fsutil
+import scipy.ndimage
+from core import fsimage, scandata, fsutil, fsstack
 import PIL
 from pathlib import Path
 
+logger = logging.getLogger(__name__)
+
+
 class Processor:
     """
-    Interface for implementing a step in the processing stack
+    Interface for implementing a step in the processing stack.
+    Processors work on the last two axes of their input, so they accept single 2D projections as well as (N, H, W) blocks of projections
     """
 
+    # True if every output value only depends on the input value at the same position (allows lookup table evaluation)
+    pointwise = True
+
     def process_static(self, arr: np.ndarray):
          """
          Process data with supplied settings
@@ -24,12 +40,106 @@ class Processor:
         """
         return self.process_static(arr)
 
+    def fingerprint(self, auto=False):
+        """
+        Describe the settings that determine the output of this processor
+        :param auto: bool if the settings are calculated automatically
+        :return: json string
+        """
+        return json.dumps(_public_dict(self), sort_keys=True, default=str)
+
+    def set_region(self, region):
+        """
+        Set region of the raw image that is processed. Only needed by processors using per pixel data
+        :param region: (x, y, x2, y2) or None for the full image
+        """
+        pass
+
+    def process_inplace(self, buf: np.ndarray, mask: np.ndarray):
+        """
+        Process data with supplied settings without allocating memory. Used by CompiledStack
+        :param buf: float32 numpy array that is overwritten with the result
+        :param mask: bool numpy array of the same shape for temporary use
+        """
+        res = self.process_static(buf)
+        if res is not buf:
+            if res.shape != buf.shape:
+                raise Exception("%s changes the shape of the data and can't be compiled" % type(self).__name__)
+            buf[...] = res
+
+def _public_dict(obj):
+    """
+    Get attributes of an object without private (underscore) attributes
+    :param obj: source object
+    :return: dict of public attributes
+    """
+    return {key: val for key, val in obj.__dict__.items() if not key.startswith('_')}
+
+class CompiledStack:
+    """
+    Execution plan for the enabled processors of a processing stack (static settings only). All processors work
+    in place on one reusable float32 buffer, which is processed in cache sized blocks, so every block passes through
+    all processors while it is in the CPU cache. The output is bit-identical to ProcessingStack.execute(arr, auto=False)
+    """
+
+    def __init__(self, stack, block_size=65536):
+        """
+        :param stack: source processing stack. Changes to processor settings are used by the plan, changes to the enable flags are not
+        :param block_size: number of values processed at once
+        """
+        self.processors = [stack.processors[i] for i in range(len(stack.processors)) if stack.processors_enable[i]]
+        # Processors using per pixel data need the complete images
+        self.block_size = block_size if all(proc.pointwise for proc in self.processors) else None
+        self.buf = None
+        self.mask = None
+
+    def execute(self, arr: np.ndarray, out=None):
+        """
+        Run numpy array through the compiled processors
+        :param arr: input numpy array
+        :param out: optional float32 output array. If None an internal buffer is reused, which is overwritten by the next call
+        :return: processed numpy array
+        """
+        if out is None:
+            if self.buf is None or self.buf.shape != arr.shape:
+                self.buf = np.empty(arr.shape, dtype=np.float32)
+            out = self.buf
+        np.copyto(out, arr, casting='unsafe')
+
+        if self.block_size is None:
+            if self.mask is None or self.mask.shape != out.shape:
+                self.mask = np.empty(out.shape, dtype=bool)
+            for proc in self.processors:
+                proc.process_inplace(out, self.mask)
+            return out
+
+        if self.mask is None or self.mask.size < min(out.size, self.block_size):
+            self.mask = np.empty(min(out.size, self.block_size), dtype=bool)
+
+        flat = out.reshape(-1) # view, out is contiguous
+        for start in range(0, flat.size, self.block_size):
+            block = flat[start:start+self.block_size]
+            mask = self.mask[:block.size]
+            for proc in self.processors:
+                proc.process_inplace(block, mask)
+
+        return out
+
 class ProcessingStack:
 
     """
     Utility to combine multiple data processors into a consecutive processing stack
     """
 
+    # Processor names of files that were saved without names (see from_dict)
+    legacy_order = None
+
+    # Maximum memory used for stage outputs by execute_cached (bytes)
+    stage_cache_limit = 256 * 1024 * 1024
+
+    # profiling.StackProfiler recording every processor call of execute and execute_batch (None = disabled)
+    profiler = None
+
     def __init__(self):
         self.processors = []
         self.processors_enable = []
@@ -56,6 +166,16 @@ class ProcessingStack:
         :return: processed numpy array
         """
         intermediate_arr = arr.astype(np.float32)
+        profiler = self.profiler
+
+        if profiler is not None:
+            profiler.start()
+            for i in range(len(self.processors)):
+                if self.processors_enable[i]:
+                    proc = self.processors[i]
+                    fun = proc.process_auto if auto else proc.process_static
+                    intermediate_arr = profiler.measure(self.processors_name[i], proc, fun, intermediate_arr)
+            return intermediate_arr
 
         for i in range(len(self.processors)):
             if self.processors_enable[i]:
@@ -66,6 +186,144 @@ class ProcessingStack:
 
         return intermediate_arr
 
+    def compile(self):
+        """
+        Create execution plan that runs the enabled processors in place without allocating temporary arrays
+        :return: CompiledStack
+        """
+        return CompiledStack(self)
+
+    def fingerprint(self):
+        """
+        Describe enable flags and settings of all processors
+        :return: string that changes whenever a setting changes
+        """
+        return json.dumps([[self.processors_name[i], self.processors_enable[i], _public_dict(self.processors[i])] for i in range(len(self.processors))], sort_keys=True, default=str)
+
+    def is_pointwise(self):
+        """
+        :return: bool if all enabled processors are pointwise functions
+        """
+        return all(self.processors[i].pointwise for i in range(len(self.processors)) if self.processors_enable[i])
+
+    def get_lut(self):
+        """
+        Get lookup table containing the output of the processing stack (static settings) for every 16 bit input value.
+        The table is rebuilt whenever a processor setting or enable flag changes
+        :return: float32 numpy array with 65536 entries
+        """
+        key = self.fingerprint()
+        cached = getattr(self, '_lut', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        if not self.is_pointwise():
+            raise Exception("Processing stack contains processors that aren't pointwise")
+
+        lut = self.compile().execute(np.arange(65536, dtype=np.uint16), out=np.empty(65536, dtype=np.float32))
+        self._lut = (key, lut) # single assignment, so concurrent threads always see a consistent pair
+        return lut
+
+    def execute_lut(self, arr: np.ndarray):
+        """
+        Run 16 bit data through processing stack (static settings) with a single lookup per value. The output is bit-identical to execute(arr, auto=False)
+        :param arr: uint16 numpy array
+        :return: processed float32 numpy array
+        """
+        if arr.dtype != np.uint16:
+            raise Exception("Lookup table evaluation requires uint16 input")
+        return np.take(self.get_lut(), arr)
+
+    def execute_cached(self, arr: np.ndarray, auto=True):
+        """
+        Run numpy array through processing stack and keep the output of every stage. On the next call with the same input array
+        the execution restarts at the first stage whose settings changed. The cache size is limited by stage_cache_limit (bytes)
+        :param arr: input numpy array
+        :param auto: bool if processors should automatically calculate their settings
+        :return: processed numpy array (not shared with the cache)
+        """
+        # Fingerprint of every stage including all previous stages and the input
+        chain = hashlib.sha1(("%d %s %s %s" % (id(arr), arr.shape, arr.dtype.str, auto)).encode())
+        fingerprints = []
+        for i in range(len(self.processors)):
+            chain.update(("%s %s %s" % (self.processors_name[i], self.processors_enable[i],
+                                        self.processors[i].fingerprint(auto) if self.processors_enable[i] else "")).encode())
+            fingerprints.append(chain.hexdigest())
+
+        old_cache = getattr(self, '_stage_cache', {})
+        start = 0
+        intermediate_arr = None
+        for i in reversed(range(len(self.processors))):
+            if old_cache.get(i, (None,))[0] == fingerprints[i]:
+                start = i + 1
+                intermediate_arr = old_cache[i][1].copy() # processors work in place, the cached data has to stay untouched
+                break
+
+        if intermediate_arr is None:
+            intermediate_arr = arr.astype(np.float32)
+
+        # Keep still valid entries, a new dict is assigned so shallow copies of the stack don't share the cache
+        cache = {i: old_cache[i] for i in range(start) if i in old_cache and old_cache[i][0] == fingerprints[i]}
+        for i in range(start, len(self.processors)):
+            if self.processors_enable[i]:
+                if auto:
+                    intermediate_arr = self.processors[i].process_auto(intermediate_arr)
+                else:
+                    intermediate_arr = self.processors[i].process_static(intermediate_arr)
+                cache[i] = (fingerprints[i], intermediate_arr.copy())
+
+        # Limit memory usage, the outputs of late stages are the most valuable ones
+        size = sum(entry[1].nbytes for entry in cache.values())
+        for i in sorted(cache):
+            if size <= self.stage_cache_limit:
+                break
+            size -= cache[i][1].nbytes
+            del cache[i]
+
+        self._stage_cache = cache
+        return intermediate_arr
+
+    def clear_cache(self):
+        """
+        Drop cached stage outputs of execute_cached
+        """
+        self._stage_cache = {}
+
+    def execute_batch(self, arr: np.ndarray, auto=False, chunk=16, mode="default"):
+        """
+        Run block of projections through processing stack
+        :param arr: input numpy array of shape (N, H, W)
+        :param auto: bool if processors should automatically calculate their settings (calculated from the whole chunk instead of single projections)
+        :param chunk: maximum number of projections passed through each processor at once (limits the size of temporary arrays)
+        :param mode: "default", "compiled" (in place, see CompiledStack) or "lut" (lookup table, see execute_lut). Only "default" supports auto
+        :return: processed numpy array of shape (N, H', W')
+        """
+        profiler = self.profiler
+        if not auto and mode == "lut":
+            if arr.dtype == np.uint16 and self.is_pointwise():
+                if profiler is not None:
+                    profiler.start()
+                    return profiler.measure("lut", self, self.execute_lut, arr)
+                return self.execute_lut(arr)
+            mode = "compiled" # lookup table not applicable
+
+        if not auto and mode == "compiled":
+            compiled = self.compile()
+            run = lambda a: compiled.execute(a, out=np.empty(a.shape, dtype=np.float32))
+            if profiler is not None:
+                profiler.start()
+                return profiler.measure("compiled", compiled, run, arr)
+            return run(arr)
+
+        out = None
+        for start in range(0, arr.shape[0], chunk):
+            block = self.execute(arr[start:start+chunk], auto=auto)
+            if out is None:
+                out = np.empty((arr.shape[0],) + block.shape[1:], dtype=block.dtype)
+            out[start:start+chunk] = block
+
+        return out
+
     def enable_all(self):
         """
         Enable all processors
@@ -108,12 +366,13 @@ class ProcessingStack:
         """
         proc_params = []
         for proc in self.processors:
-            proc_params.append(proc.__dict__)
+            proc_params.append(_public_dict(proc))
 
         if dic is None:
             dic = {}
 
         dic[name] = proc_params
+        dic[name + "_names"] = list(self.processors_name)
 
         return dic
 
@@ -123,21 +382,332 @@ class ProcessingStack:
         :param name: dictionary key
         :param dic: dict containing processor settings
         """
+        # Settings are assigned by processor name. Files without names store the processors in legacy_order
+        names = dic.get(name + "_names", self.legacy_order)
         for i in range(len(self.processors)):
+            if names is not None and self.processors_name[i] not in names:
+                continue # processor didn't exist when the file was saved, keep defaults
             try:
-                for key, val in dic[name][i].items():
+                idx = names.index(self.processors_name[i]) if names is not None else i
+                for key, val in dic[name][idx].items():
                     setattr(self.processors[i], key, val)
             except Exception as e:
                 print("ProcessingStack from_dict warning: " + str(e))
                 #traceback.print_exc()
 
+    def set_region(self, region):
+        """
+        Tell all processors which region of the raw image they are processing
+        :param region: (x, y, x2, y2) or None for the full image
+        """
+        for proc in self.processors:
+            proc.set_region(region)
+
 class XRayProcessingStack(ProcessingStack):
     """
     Default processing stack for converting X-ray images to attenuation values
     """
+    legacy_order = ["normalize_raw", "limit_pre", "normalize_pre", "log", "limit_post", "normalize_final"]
+
     def __init__(self):
         super().__init__()
-        self.push(NormalizeProc(min=None, max=1),"normalize_raw").push(LimitProcAlt(), "limit_pre").push(NormalizeProc(min=None, max=1), "normalize_pre").push(LogProc(), "log").push(LimitProcAlt(), "limit_post").push(NormalizeProc(min=None, max=1), "normalize_final")#push(CropProc(0, 0, 256, 256), "crop")
+        self.push(DefectPixelProc(), "defects").push(FlatFieldProc(), "flatfield").push(NormalizeProc(min=None, max=1),"normalize_raw").push(LimitProcAlt(), "limit_pre").push(NormalizeProc(min=None, max=1), "normalize_pre")\
+            .push(MedianDenoiseProc(), "denoise_median").push(BilateralDenoiseProc(), "denoise_bilateral").push(NLMeansDenoiseProc(), "denoise_nlmeans")\
+            .push(LogProc(), "log").push(LimitProcAlt(), "limit_post").push(NormalizeProc(min=None, max=1), "normalize_final")#push(CropProc(0, 0, 256, 256), "crop")
+
+class DefectPixelProc(Processor):
+    def __init__(self, map_path=None, map_region=None):
+        """
+        Replace defect pixels (dust, dead and hot pixels) by their nearest valid neighbor. Inactive as long as no defect map is set
+        :param map_path: path of defect map (.npy, bool, True for defect pixels)
+        :param map_region: region (x, y, x2, y2) of the raw image covered by the map
+        """
+        self.map_path = map_path
+        self.map_region = map_region
+        self.region = None
+        self._indices = None # (key, flat indices of defect pixels, flat indices of their replacements), key includes the file signature
+
+    @property
+    def pointwise(self):
+        return not self.is_active()
+
+    def is_active(self):
+        return self.map_path is not None
+
+    def set_region(self, region):
+        self.region = list(region) if region is not None else None
+
+    def fingerprint(self, auto=False):
+        # A rebuilt map keeps its path
+        files = fsstack.file_signature([self.map_path]) if self.is_active() else None
+        return json.dumps([_public_dict(self), files], sort_keys=True, default=str)
+
+    def get_indices(self, shape):
+        """
+        Precalculate the positions of defect pixels and their replacements in images of the processed region.
+        The map is loaded again when its file changes (e.g. after CTScan.build_defect_map)
+        :param shape: shape of a single processed image (H, W)
+        :return: tuple (defect indices, replacement indices) into the flattened image
+        """
+        key = (self.map_path, fsstack.file_signature([self.map_path]), tuple(self.map_region) if self.map_region else None,
+               tuple(self.region) if self.region else None, tuple(shape))
+        indices = self._indices
+        if indices is not None and indices[0] == key:
+            return indices[1], indices[2]
+
+        defects = np.load(self.map_path)
+        # Nearest valid pixel for every pixel of the map
+        near_y, near_x = scipy.ndimage.distance_transform_edt(defects, return_distances=False, return_indices=True)
+        dy, dx = np.nonzero(defects)
+        sy, sx = near_y[dy, dx], near_x[dy, dx]
+
+        # Translate map coordinates to coordinates of the processed region
+        off_x = (self.map_region[0] if self.map_region else 0) - (self.region[0] if self.region else 0)
+        off_y = (self.map_region[1] if self.map_region else 0) - (self.region[1] if self.region else 0)
+        dy, dx, sy, sx = dy + off_y, dx + off_x, sy + off_y, sx + off_x
+        h, w = shape
+        inside = (dy >= 0) & (dy < h) & (dx >= 0) & (dx < w) & (sy >= 0) & (sy < h) & (sx >= 0) & (sx < w)
+
+        dst = dy[inside] * w + dx[inside]
+        src = sy[inside] * w + sx[inside]
+        self._indices = (key, dst, src)
+        return dst, src
+
+    def process_static(self, arr):
+        if not self.is_active():
+            return arr
+
+        dst, src = self.get_indices(arr.shape[-2:])
+        flat = arr.reshape(-1, arr.shape[-2] * arr.shape[-1]) # view of contiguous data
+        flat[:, dst] = flat[:, src]
+        logger.debug("Repaired %d defect pixels", len(dst))
+        return arr
+
+    def process_inplace(self, buf, mask):
+        if not self.is_active():
+            return
+
+        dst, src = self.get_indices(buf.shape[-2:])
+        flat = buf.reshape(-1, buf.shape[-2] * buf.shape[-1])
+        flat[:, dst] = flat[:, src]
+
+class FlatFieldProc(Processor):
+    def __init__(self, dark_path=None, flat_path=None):
+        """
+        Flat-field and dark-frame correction (I - D) / (F - D). Inactive as long as no master frames are set
+        :param dark_path: path of master dark frame (.npy, full raw image size)
+        :param flat_path: path of master flat frame (.npy, full raw image size)
+        """
+        self.dark_path = dark_path
+        self.flat_path = flat_path
+        self.region = None
+        self._masters = None # (key, offset, gain) cropped to the processed region, key includes the file signatures
+
+    @property
+    def pointwise(self):
+        return not self.is_active()
+
+    def is_active(self):
+        return self.dark_path is not None and self.flat_path is not None
+
+    def set_region(self, region):
+        self.region = list(region) if region is not None else None
+
+    def fingerprint(self, auto=False):
+        # Rebuilt master frames keep their paths
+        files = fsstack.file_signature([self.dark_path, self.flat_path]) if self.is_active() else None
+        return json.dumps([_public_dict(self), files], sort_keys=True, default=str)
+
+    def get_masters(self, shape):
+        """
+        Load master frames and precalculate offset D and gain 1/(F - D) for the processed region.
+        The frames are loaded again when their files change (e.g. after CTScan.build_master_frames)
+        :param shape: shape of a single processed image (H, W)
+        :return: tuple (offset, gain) float32 numpy arrays
+        """
+        key = (self.dark_path, self.flat_path, fsstack.file_signature([self.dark_path, self.flat_path]),
+               tuple(self.region) if self.region else None, tuple(shape))
+        masters = self._masters
+        if masters is not None and masters[0] == key:
+            return masters[1], masters[2]
+
+        dark = np.load(self.dark_path, mmap_mode='r')
+        flat = np.load(self.flat_path, mmap_mode='r')
+        if self.region is not None and tuple(shape) != dark.shape:
+            x, y, x2, y2 = fsimage.clamp_region(self.region, dark.shape[1], dark.shape[0])
+            dark = dark[y:y2, x:x2]
+            flat = flat[y:y2, x:x2]
+        if dark.shape != tuple(shape):
+            raise Exception("Master frames (%s) don't match image size (%s)" % (dark.shape, shape))
+
+        offset = np.array(dark, dtype=np.float32)
+        gain = np.array(flat, dtype=np.float32) - offset
+        valid = gain > 0
+        np.divide(1, gain, out=gain, where=valid)
+        gain[~valid] = 0 # dead pixels of the flat frame
+
+        self._masters = (key, offset, gain)
+        return offset, gain
+
+    def process_static(self, arr):
+        if not self.is_active():
+            return arr
+
+        offset, gain = self.get_masters(arr.shape[-2:])
+        arr -= offset
+        arr *= gain
+        logger.debug("Flat-field corrected")
+        return arr
+
+    def process_inplace(self, buf, mask):
+        if not self.is_active():
+            return
+
+        offset, gain = self.get_masters(buf.shape[-2:])
+        np.subtract(buf, offset, out=buf)
+        np.multiply(buf, gain, out=buf)
+
+class TiledDenoiseProc(Processor):
+    def __init__(self, tile_size=256, workers=4):
+        """
+        Base class for denoising filters. Every image is split into tiles that overlap by the filter radius and the tiles
+        are filtered by a pool of threads (OpenCV releases the GIL). The result is the same as filtering the whole image.
+        The threads only live during a call, so processors can be used in forked worker processes (batch_mode "pool")
+        :param tile_size: size of tiles without overlap
+        :param workers: number of threads
+        """
+        self.tile_size = tile_size
+        self.workers = workers
+        self._time = 0.0
+        self._count = 0
+
+    @property
+    def pointwise(self):
+        return not self.is_active()
+
+    def is_active(self):
+        return False
+
+    def get_overlap(self):
+        """
+        :return: number of pixels around a tile that are needed to filter it
+        """
+        return 0
+
+    def filter_tile(self, tile):
+        """
+        Filter single tile
+        :param tile: contiguous float32 numpy array
+        :return: filtered tile
+        """
+        return tile
+
+    def get_time_per_projection(self):
+        """
+        :return: average time in seconds needed to denoise one projection
+        """
+        return self._time / self._count if self._count else 0.0
+
+    def __filter_image(self, img, out, executor):
+        h, w = img.shape
+        ov = self.get_overlap()
+
+        def run(tile):
+            y, x = tile
+            y2, x2 = min(y + self.tile_size, h), min(x + self.tile_size, w)
+            py, px = max(y - ov, 0), max(x - ov, 0)
+            py2, px2 = min(y2 + ov, h), min(x2 + ov, w)
+            res = self.filter_tile(np.ascontiguousarray(img[py:py2, px:px2]))
+            out[y:y2, x:x2] = res[y-py:y2-py, x-px:x2-px]
+
+        tiles = [(y, x) for y in range(0, h, self.tile_size) for x in range(0, w, self.tile_size)]
+        list(executor.map(run, tiles))
+
+    def process_static(self, arr):
+        if not self.is_active():
+            return arr
+
+        start = time.perf_counter()
+        out = np.empty(arr.shape, dtype=np.float32)
+        images = arr.reshape((-1,) + arr.shape[-2:])
+        out_images = out.reshape(images.shape)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for k in range(images.shape[0]):
+                self.__filter_image(images[k], out_images[k], executor)
+
+        elapsed = time.perf_counter() - start
+        self._time += elapsed
+        self._count += images.shape[0]
+        logger.debug("Denoised (%s) in %f s per projection", type(self).__name__, elapsed / images.shape[0])
+        return out
+
+class MedianDenoiseProc(TiledDenoiseProc):
+    def __init__(self, size=0, tile_size=256, workers=4):
+        """
+        Median filter
+        :param size: kernel size (odd). 0 disables the filter
+        """
+        super().__init__(tile_size, workers)
+        self.size = size
+
+    def is_active(self):
+        return self.size is not None and self.size > 1
+
+    def get_overlap(self):
+        return self.size // 2
+
+    def filter_tile(self, tile):
+        if self.size in (3, 5):
+            return cv2.medianBlur(tile, self.size) # OpenCV only supports float data for these sizes
+        return scipy.ndimage.median_filter(tile, size=self.size, mode='nearest')
+
+class BilateralDenoiseProc(TiledDenoiseProc):
+    def __init__(self, diameter=0, sigma_color=0.05, sigma_space=3, tile_size=256, workers=4):
+        """
+        Bilateral filter (edge preserving)
+        :param diameter: diameter of pixel neighborhood. 0 disables the filter
+        :param sigma_color: filter sigma in value range (input is normalized to 0..1)
+        :param sigma_space: filter sigma in pixels
+        """
+        super().__init__(tile_size, workers)
+        self.diameter = diameter
+        self.sigma_color = sigma_color
+        self.sigma_space = sigma_space
+
+    def is_active(self):
+        return self.diameter is not None and self.diameter > 0
+
+    def get_overlap(self):
+        return self.diameter // 2 + 1
+
+    def filter_tile(self, tile):
+        return cv2.bilateralFilter(tile, self.diameter, self.sigma_color, self.sigma_space, borderType=cv2.BORDER_REPLICATE)
+
+class NLMeansDenoiseProc(TiledDenoiseProc):
+    def __init__(self, h=0, template_size=7, search_size=21, tile_size=256, workers=4):
+        """
+        Non-local means filter
+        :param h: filter strength in value range (input is normalized to 0..1). 0 disables the filter
+        :param template_size: size of compared patches (odd)
+        :param search_size: size of search window (odd)
+        """
+        super().__init__(tile_size, workers)
+        self.h = h
+        self.template_size = template_size
+        self.search_size = search_size
+
+    def is_active(self):
+        return self.h is not None and self.h > 0
+
+    def get_overlap(self):
+        return self.search_size // 2 + self.template_size // 2
+
+    def filter_tile(self, tile):
+        # OpenCV only supports 8 and 16 bit data for non-local means
+        scl = np.iinfo("uint16").max
+        tile16 = (np.clip(tile, 0, 1) * scl).astype(np.uint16)
+        res = cv2.fastNlMeansDenoising(tile16, h=[self.h * scl], templateWindowSize=self.template_size, searchWindowSize=self.search_size, normType=cv2.NORM_L1)
+        return res.astype(np.float32) / scl
 
 class LimitProc(Processor):
     def __init__(self, low=None, high=None):
@@ -156,9 +726,18 @@ class LimitProc(Processor):
         if self.high_limit is not None:
             arr[arr > self.high_limit] = self.high_limit
 
-        print("Limited from %f to %f" % (self.low_limit, self.high_limit))
+        logger.debug("Limited from %f to %f", self.low_limit, self.high_limit)
         return arr
 
+    def process_inplace(self, buf, mask):
+        if self.low_limit is not None:
+            np.less(buf, self.low_limit, out=mask)
+            np.copyto(buf, self.low_limit, where=mask)
+
+        if self.high_limit is not None:
+            np.greater(buf, self.high_limit, out=mask)
+            np.copyto(buf, self.high_limit, where=mask)
+
 class LimitProcAlt(Processor):
     def __init__(self, low=None, high=None):
         """
@@ -176,10 +755,21 @@ class LimitProcAlt(Processor):
         if self.high_limit is not None:
             arr[arr > self.high_limit] = self.high_limit
 
-        print("Limited from %f to %f" % (self.low_limit, self.high_limit))
+        logger.debug("Limited from %f to %f", self.low_limit, self.high_limit)
         return arr
 
+    def process_inplace(self, buf, mask):
+        if self.low_limit is not None:
+            np.less(buf, self.low_limit, out=mask)
+            np.copyto(buf, 0, where=mask)
+
+        if self.high_limit is not None:
+            np.greater(buf, self.high_limit, out=mask)
+            np.copyto(buf, self.high_limit, where=mask)
+
 class CropProc(Processor):
+    pointwise = False
+
     def __init__(self, x, y, w, h):
         """
         Crop image to specified size
@@ -194,7 +784,7 @@ class CropProc(Processor):
         self.h = h
 
     def process_static(self, arr: np.ndarray):
-        return arr[round(self.x):round(self.x+self.w), round(self.y):round(self.y+self.h)]
+        return arr[..., round(self.x):round(self.x+self.w), round(self.y):round(self.y+self.h)]
 
 class NormalizeProc(Processor):
     def __init__(self, min=None, max=None):
@@ -213,9 +803,22 @@ class NormalizeProc(Processor):
         if self.max is not None:
             arr /= self.max
 
-        print("Normalized (min: %f, max: %f)" % (self.min if self.min else -1, self.max if self.max else -1))
+        logger.debug("Normalized (min: %f, max: %f)", self.min if self.min else -1, self.max if self.max else -1)
         return arr
 
+    def process_inplace(self, buf, mask):
+        if self.min is not None:
+            np.subtract(buf, self.min, out=buf)
+
+        if self.max is not None:
+            np.divide(buf, self.max, out=buf)
+
+    def fingerprint(self, auto=False):
+        if auto:
+            # min and max are calculated from the data, only their use matters
+            return json.dumps([self.min is not None, self.max is not None])
+        return super().fingerprint(auto)
+
     def process_auto(self, arr: np.ndarray):
         if self.min is not None:
             self.min = float(np.min(arr))
@@ -232,7 +835,40 @@ class LogProc(Processor):
    def process_static(self, arr):
         arr = -np.log(arr)
         #arr = np.nan_to_num(arr)
-        print("Calculated minus log")
+        logger.debug("Calculated minus log")
         return arr
 
+   def process_inplace(self, buf, mask):
+        np.log(buf, out=buf)
+        np.negative(buf, out=buf)
+
 
+def benchmark(stack: ProcessingStack, arr: np.ndarray, repeat=20):
+    """
+    Compare time and memory usage of ProcessingStack.execute, CompiledStack.execute and ProcessingStack.execute_lut (static settings)
+    :param stack: processing stack to be measured
+    :param arr: input projection
+    :param repeat: number of runs per mode
+    :return: dict with time per projection in seconds and peak of temporary memory per projection in bytes (measured with tracemalloc)
+    """
+    compiled = stack.compile()
+    compiled.execute(arr) # allocate reusable buffers before measuring
+    modes = {'default': lambda: stack.execute(arr, auto=False), 'compiled': lambda: compiled.execute(arr)}
+    if arr.dtype == np.uint16 and stack.is_pointwise():
+        stack.get_lut() # build table before measuring
+        modes['lut'] = lambda: stack.execute_lut(arr)
+
+    results = {}
+    for name, run in modes.items():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run()
+        results['time_' + name] = (time.perf_counter() - start) / repeat
+
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results['peak_bytes_' + name] = peak
+
+    return results
@@ -0,0 +1,158 @@
+import csv
+import json
+import threading
+import time
+import tracemalloc
+
+"""
+Instrumentation for processing stacks. A StackProfiler attached to ProcessingStack.profiler records wall time,
+temporarily allocated memory and input/output shapes of every processor call. Without a profiler the stack runs its
+normal code path, so disabled instrumentation costs a single attribute check per call.
+"""
+
+
+def _reset_peak():
+    """
+    Reset the peak of traced memory. tracemalloc.reset_peak needs Python 3.9, older versions restart tracing instead
+    (which also drops the traces of concurrent calls)
+    """
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.stop()
+        tracemalloc.start()
+
+
+class StackProfiler:
+    """
+    Collects one record per processor call. Thread safe, so it can be shared by the worker threads of a pipeline.
+    Calls in other processes (e.g. batch_mode "pool") are not recorded
+    """
+
+    fields = ['stage', 'processor', 'time', 'peak_bytes', 'in_shape', 'out_shape', 'in_dtype', 'out_dtype']
+
+    def __init__(self, trace_memory=True):
+        """
+        :param trace_memory: bool if allocated memory is measured with tracemalloc (slows down allocations while active)
+        """
+        self.trace_memory = trace_memory
+        self.records = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Start memory tracing. Called by the stack before running processors
+        """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        """
+        Stop memory tracing
+        """
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def measure(self, name, proc, fun, arr):
+        """
+        Run a single processor call and record it
+        :param name: name of the stage in the processing stack
+        :param proc: Processor
+        :param fun: function called with arr (e.g. proc.process_static)
+        :param arr: input numpy array
+        :return: output of fun
+        """
+        in_shape, in_dtype = list(arr.shape), arr.dtype.str
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing:
+            _reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+
+        start = time.perf_counter()
+        out = fun(arr)
+        elapsed = time.perf_counter() - start
+
+        # Peak memory is global, with multiple threads it includes allocations of concurrent calls
+        peak = tracemalloc.get_traced_memory()[1] - base if tracing else None
+        record = {'stage': name, 'processor': type(proc).__name__, 'time': elapsed, 'peak_bytes': peak,
+                  'in_shape': in_shape, 'out_shape': list(out.shape), 'in_dtype': in_dtype, 'out_dtype': out.dtype.str}
+        with self.lock:
+            self.records.append(record)
+        return out
+
+    def clear(self):
+        with self.lock:
+            self.records = []
+
+    def summary(self):
+        """
+        Aggregate records per stage
+        :return: list of dicts (stage, processor, calls, images, total time, mean time per call, time per image, max peak bytes) in order of first appearance
+        """
+        stages = {}
+        with self.lock:
+            records = list(self.records)
+
+        for r in records:
+            s = stages.setdefault(r['stage'], {'stage': r['stage'], 'processor': r['processor'], 'calls': 0, 'images': 0,
+                                               'time': 0.0, 'peak_bytes': None})
+            s['calls'] += 1
+            s['images'] += r['in_shape'][0] if len(r['in_shape']) == 3 else 1
+            s['time'] += r['time']
+            if r['peak_bytes'] is not None:
+                s['peak_bytes'] = max(s['peak_bytes'] or 0, r['peak_bytes'])
+
+        for s in stages.values():
+            s['time_per_call'] = s['time'] / s['calls']
+            s['time_per_image'] = s['time'] / s['images'] if s['images'] else 0.0
+        return list(stages.values())
+
+    def print_summary(self):
+        """
+        Print aggregated records. The stage with the highest total time is the bottleneck
+        """
+        summary = self.summary()
+        for s in summary:
+            print("Stage %s (%s): %d calls, %d images, %.3fs total, %.2fms per image, peak %s bytes" %
+                  (s['stage'], s['processor'], s['calls'], s['images'], s['time'], s['time_per_image'] * 1000, s['peak_bytes']))
+        if summary:
+            print("Slowest stage: %s" % max(summary, key=lambda s: s['time'])['stage'])
+
+    def export_json(self, path):
+        """
+        Save summary and all records as json file
+        :param path: output file path
+        """
+        with self.lock:
+            records = list(self.records)
+        with open(str(path), 'w') as f:
+            json.dump({'summary': self.summary(), 'records': records}, f, indent=4)
+
+    def export_csv(self, path, summary=False):
+        """
+        Save records as csv file, one line per processor call
+        :param path: output file path
+        :param summary: bool if the aggregated summary is saved instead (one line per stage)
+        """
+        if summary:
+            rows = self.summary()
+            fields = ['stage', 'processor', 'calls', 'images', 'time', 'time_per_call', 'time_per_image', 'peak_bytes']
+        else:
+            with self.lock:
+                rows = [dict(r, in_shape='x'.join(map(str, r['in_shape'])), out_shape='x'.join(map(str, r['out_shape'])))
+                        for r in self.records]
+            fields = self.fields
+
+        with open(str(path), 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
@@ -1,9 +1,16 @@
+import multiprocessing
+import tempfile
+import time
 from pathlib import Path
 
 import astra
 import numpy as np
+import scipy.ndimage
 
-from core import fsutil, scandata
+from core import fsutil, scandata, fdk
+
+# ASTRA CPU algorithms for single slices, used by ReconAstra2DRows
+row_algorithms = ("FBP", "SIRT", "SART")
 
 
 class ReconstructionProvider:
@@ -16,6 +23,184 @@ class ReconstructionProvider:
     def reconstruct(self):
         pass
 
+    def get_geometry(self):
+        """
+        Calculate axis shift and source distance shared by all providers. All lengths are in detector pixels of the downsampled projections
+        :return: tuple (axis shift, distance of the source from the rotation axis)
+        """
+        recon_params = self.scan.reconstruction_parameters
+        geo_scan = self.scan.processing_parameters
+
+        shift = geo_scan.get_shift_x()+(recon_params.axis_adj/geo_scan.downsample)
+        print("Axis Shift: %f" % shift)
+
+        # Magnification
+        det_spacing = geo_scan.get_detector_spacing()
+        print("Downsample: %f; Detector Spacing: %f; " % (geo_scan.downsample, det_spacing))
+        return shift, (recon_params.dist_source_origin+recon_params.dist_origin_detector)/det_spacing
+
+    def get_roi(self, h, w):
+        """
+        Calculate volume size and window of the region of interest (ReconstructionParameters.roi) in pixels of the downsampled projections
+        :param h: number of detector rows
+        :param w: number of detector cols
+        :return: None if the whole field of view is reconstructed, otherwise tuple (volume size (slices, rows, cols),
+                 window (minx, maxx, miny, maxy, minz, maxz) relative to the center of the full volume)
+        """
+        recon_params = self.scan.reconstruction_parameters
+        if not recon_params.roi:
+            return None
+
+        downsample = self.scan.processing_parameters.downsample
+        x0, y0, z0, x1, y1, z1 = [v / downsample for v in recon_params.roi]
+        voxel_size = recon_params.roi_voxel_size / downsample
+        shape = tuple(max(1, int(round(abs(b - a) / voxel_size))) for a, b in ((z0, z1), (y0, y1), (x0, x1)))
+
+        minx, miny, minz = min(x0, x1) - w / 2, min(y0, y1) - w / 2, min(z0, z1) - h / 2
+        window = (minx, minx + shape[2] * voxel_size, miny, miny + shape[1] * voxel_size, minz, minz + shape[0] * voxel_size)
+        print("Region of interest: %d x %d x %d voxels, voxel size %f" % (shape[2], shape[1], shape[0], voxel_size))
+        return shape, window
+
+    def reconstruct_multires(self, solve):
+        """
+        Run iterative reconstruction coarse to fine (ReconstructionParameters.multires). Every level is initialized with
+        the upsampled result of the previous level, so the fine levels need only a few iterations
+        :param solve: function (projections, level factor, iterations, initial volume or None) returning the reconstructed volume.
+                      Lengths in pixels of the level are the lengths of the finest level divided by the level factor
+        :return: reconstructed volume of the last level
+        """
+        recon_params = self.scan.reconstruction_parameters
+        geo_scan = self.scan.processing_parameters
+
+        volume = None
+        prev_factor = None
+        for factor, iterations in recon_params.multires:
+            start = time.perf_counter()
+            projections = self.scan.load_projections(recon_params.in_name, downsample=geo_scan.downsample * factor)
+            h, num, w = projections.shape
+
+            init = None
+            if volume is not None:
+                # Reconstructed values are attenuation per voxel, so they scale with the voxel size
+                init = upsample_volume(volume, (h, w, w), factor / prev_factor)
+            volume = solve(projections, factor, iterations, init)
+            prev_factor = factor
+            print("Level %s: %d x %d x %d voxels, %d iterations in %fs" % (factor, w, w, h, iterations, time.perf_counter() - start))
+
+        return volume
+
+    def save(self, reconstructed):
+        """
+        Normalize reconstructed volume and export it to recon/<out_name>.tiff. The volume is not modified, so it may be
+        a read-only memory map. Negative values are exported as 0
+        :param reconstructed: numpy array in (slices, rows, cols) layout
+        """
+        recon_params = self.scan.reconstruction_parameters
+
+        max_val = max(float(np.max(reconstructed)), 0.0)
+        if max_val == 0:
+            max_val = 1.0
+
+        if recon_params.high_output != 1:
+            scale = 1.0/(max_val*recon_params.high_output) # values above 1 are clipped during export
+            print("Rescaling!")
+        else:
+            scale = 1.0/max_val
+        #reconstructed = np.round(reconstructed * 255).astype(np.uint8)
+
+        if recon_params.out_format == "multipage":
+            fsutil.save_np_as_multipage(reconstructed, str(self.scan.path.parent / Path("recon/" + recon_params.out_name + ".tiff")), cutaxis=0, scale=scale, compression=recon_params.out_compression)
+        else:
+            fsutil.save_np_as_img(reconstructed, str(self.scan.path.parent / Path("recon/" + recon_params.out_name + ".tiff")), cutaxis=0, scale=scale)
+
+def upsample_volume(volume, shape, scale=1.0):
+    """
+    Resample volume to a finer grid covering the same region (linear interpolation)
+    :param volume: numpy array in (slices, rows, cols) layout
+    :param shape: new size (slices, rows, cols)
+    :param scale: factor applied to the values
+    :return: float32 numpy array of the given shape
+    """
+    out = np.asarray(volume, dtype=np.float32)
+    for axis, n in enumerate(shape):
+        m = out.shape[axis]
+        # Align voxel centers of both grids, values outside are extended from the border
+        coords = np.clip((np.arange(n) + 0.5) * (m / float(n)) - 0.5, 0, m - 1)
+        i0 = np.floor(coords).astype(int)
+        i1 = np.minimum(i0 + 1, m - 1)
+        t = (coords - i0).astype(np.float32).reshape([-1 if a == axis else 1 for a in range(out.ndim)])
+        low = np.take(out, i0, axis=axis)
+        out = low + (np.take(out, i1, axis=axis) - low) * t
+    out *= scale
+    return out
+
+
+def get_slab_rows(z0, z1, h, w, source_dist, radius=None):
+    """
+    Find the detector rows hit by rays through a slab of slices of the cone beam volume (ASTRA cone geometry, detector through the rotation axis)
+    :param z0: first slice (lower boundary, may be fractional)
+    :param z1: last slice + 1 (upper boundary, may be fractional)
+    :param h: number of slices (and detector rows)
+    :param w: number of rows/cols of the volume
+    :param source_dist: distance of the source from the rotation axis in pixels
+    :param radius: maximum distance of the slab from the rotation axis (default: corners of the full volume)
+    :return: tuple (first row, last row + 1)
+    """
+    if radius is None:
+        radius = w / np.sqrt(2) # corners of the volume
+    if source_dist <= radius:
+        raise Exception("Source inside reconstruction volume")
+    mag = (source_dist / (source_dist + radius), source_dist / (source_dist - radius))
+
+    # Slice and row boundaries relative to the central plane, the slab projects larger the closer it is to the source
+    lo = min((z0 - h / 2) * m for m in mag)
+    hi = max((z1 - h / 2) * m for m in mag)
+    r0 = int(np.floor(lo + h / 2)) - 1 # one more row for interpolation
+    r1 = int(np.ceil(hi + h / 2)) + 1
+    return max(r0, 0), min(r1, h)
+
+
+def plan_slabs(h, num, w, source_dist, memory_limit, pad=True):
+    """
+    Split volume into slabs of slices, so that the projection rows and the volume of each slab fit into the memory limit
+    :param h: number of slices (and detector rows)
+    :param num: number of projections
+    :param w: number of rows/cols of the volume
+    :param source_dist: distance of the source from the rotation axis in pixels
+    :param memory_limit: memory limit in bytes (float32 projections and volume)
+    :param pad: bool if slabs are extended to their own row span, i.e. to all slices whose attenuation is contained in the
+                detector rows of the slab. Iterative algorithms need this, because otherwise the attenuation of neighboring
+                slices would be assigned to the slab
+    :return: list of tuples (first slice, last slice + 1, first reconstructed slice, last reconstructed slice + 1, first row, last row + 1)
+    """
+    def plan(size):
+        slabs = []
+        for z0 in range(0, h, size):
+            z1 = min(z0 + size, h)
+            e0, e1 = z0, z1
+            if pad:
+                # Padding slices: the row span of the slab (detector rows and slices share the same axis)
+                e0, e1 = get_slab_rows(z0, z1, h, w, source_dist)
+            r0, r1 = get_slab_rows(e0, e1, h, w, source_dist)
+            slabs.append((z0, z1, e0, e1, r0, r1))
+        return slabs
+
+    def cost(slabs):
+        return max(((r1 - r0) * num * w + (e1 - e0) * w * w) * 4 for z0, z1, e0, e1, r0, r1 in slabs)
+
+    # Largest slab size within the limit, the cost grows with the slab size
+    low, high = 1, h
+    if cost(plan(low)) > memory_limit:
+        raise Exception("Memory limit too small for a single slice")
+    while low < high:
+        mid = (low + high + 1) // 2
+        if cost(plan(mid)) <= memory_limit:
+            low = mid
+        else:
+            high = mid - 1
+    return plan(low)
+
+
 class ReconAstra3DCone(ReconstructionProvider):
 
     """
@@ -32,37 +217,58 @@ class ReconAstra3DCone(ReconstructionProvider):
         angles = self.scan.get_reached_angles_rad()
         print(angles)
 
-        # Load projections into numpy array
-        projections_raw = fsutil.load_img_as_np(str(self.scan.path.parent / Path("proj/" + recon_params.in_name + ".tiff")), stackaxis=1, downsample=geo_scan.downsample)
+        # Calculate misalignment of rotation axis and reconstruction geometry
+
+        shift, source_dist = self.get_geometry()
+
+        # Multi-resolution: levels are reconstructed coarse to fine, every level loads its own projections
+        if recon_params.multires:
+            if recon_params.roi:
+                raise Exception("Region of interest is not supported by multi-resolution reconstruction")
+            if recon_params.memory_limit:
+                raise Exception("Memory limit is not supported by multi-resolution reconstruction")
 
+            def solve(projections, factor, iterations, init):
+                lh, lnum, lw = projections.shape
+                return self.reconstruct_subset(projections, angles, shift / factor, source_dist / factor, 0, lh, (lh, lw, lw),
+                                               (-lw / 2, lw / 2, -lw / 2, lw / 2, -lh / 2, lh / 2), iterations, init)
+            self.save(self.reconstruct_multires(solve))
+            return
+
+        # Load projections into numpy array
+        projections_raw = self.scan.load_projections(recon_params.in_name, downsample=geo_scan.downsample)
 
         h, num, w = projections_raw.shape
         print(w, num, h)
         print()
 
-        # Calculate misalignment of rotation axis
-
-        centerx = geo_scan.get_center()[0]
-        rotaxis = geo_scan.get_rotaxis_x()
-        #shift = (rotaxis-centerx+recon_params.axis_adj)/float(self.scan.downsample)
-        shift = geo_scan.get_shift_x()+(recon_params.axis_adj/geo_scan.downsample)
-        print("Axis Shift: %f" % shift)
-
-        # Calculate reconstruction geometry
+        # Region of interest: only the detector rows hit by rays through the region are used
+        roi = self.get_roi(h, w)
+        if roi is not None:
+            shape, window = roi
+            radius = max(np.hypot(x, y) for x in window[0:2] for y in window[2:4])
+            r0, r1 = get_slab_rows(window[4] + h / 2, window[5] + h / 2, h, w, source_dist, radius)
+            self.save(self.reconstruct_subset(projections_raw, angles, shift, source_dist, r0, r1, shape, window))
+            return
 
-        # Magnification
-        det_spacing = geo_scan.get_detector_spacing()
+        # Slab mode: projections and volume don't fit into the memory limit
+        memory_limit = recon_params.memory_limit * 1024 * 1024
+        if memory_limit and (h * num * w + h * w * w) * 4 > memory_limit:
+            self.reconstruct_slabs(projections_raw, angles, shift, source_dist, memory_limit)
+            return
 
-        print("Downsample: %f; Detector Spacing: %f; " % (geo_scan.downsample, det_spacing))
-        #projection_geometry = astra.create_proj_geom('cone', det_spacing*recon_params.axis_adj, det_spacing*recon_params.axis_adj, h, w, angles, recon_params.dist_source_origin, recon_params.dist_origin_detector) # 2800 10
-        projection_geometry = astra.create_proj_geom('cone', 1, 1, h, w, angles, (recon_params.dist_source_origin+recon_params.dist_origin_detector)/det_spacing, 0) # 2800 10
+        projection_geometry = astra.create_proj_geom('cone', 1, 1, h, w, angles, source_dist, 0) # 2800 10
         #projection_geometry_vec = astra.geom_2vec(projection_geometry)
         projection_geometry_corrected = astra.geom_postalignment(projection_geometry, [-shift, 0])
         volume_geometry = astra.create_vol_geom(w, w, h)
 
         # Allocate memory
 
-        projections_id = astra.data3d.create('-proj3d', projection_geometry_corrected, projections_raw)
+        if isinstance(projections_raw, np.memmap) and projections_raw.flags['C_CONTIGUOUS']:
+            # Use memory mapped projection stack without copying it
+            projections_id = astra.data3d.link('-proj3d', projection_geometry_corrected, projections_raw)
+        else:
+            projections_id = astra.data3d.create('-proj3d', projection_geometry_corrected, projections_raw)
         reconstruction_id = astra.data3d.create('-vol', volume_geometry, data=0)
 
         # Configure algorithm
@@ -76,22 +282,280 @@ class ReconAstra3DCone(ReconstructionProvider):
 
         # Export to disk
 
-        reconstructed = astra.data3d.get(reconstruction_id)
-        reconstructed[reconstructed < 0] = 0
-        #reconstructed = reconstructed[:,: :]
+        self.save(astra.data3d.get(reconstruction_id))
 
-        if recon_params.high_output != 1:
-            reconstructed /= (np.max(reconstructed)*recon_params.high_output)
-            reconstructed[reconstructed > 1] = 1
-            print("Rescaling!")
-        else:
-            reconstructed /= np.max(reconstructed)
-        #reconstructed = np.round(reconstructed * 255).astype(np.uint8)
+        # Free memory
 
-        fsutil.save_np_as_img(reconstructed, str(self.scan.path.parent / Path("recon/" + recon_params.out_name + ".tiff")), cutaxis=0)
+        astra.algorithm.delete(algorithm_id)
+        astra.data3d.delete(reconstruction_id)
+        astra.data3d.delete(projections_id)
 
-        # Free memory
+    def reconstruct_slabs(self, projections_raw, angles, shift, source_dist, memory_limit):
+        """
+        Reconstruct volume slab by slab. Only the projection rows needed by the current slab are loaded and every slab
+        is written to a memory mapped volume on disk before the next one is started
+        :param projections_raw: numpy array in (rows, angles, cols) layout, should be a memory map
+        :param angles: projection angles in radians
+        :param shift: axis shift in pixels
+        :param source_dist: distance of the source from the rotation axis in pixels
+        :param memory_limit: memory limit in bytes
+        """
+        recon_params = self.scan.reconstruction_parameters
+        h, num, w = projections_raw.shape
+
+        slabs = plan_slabs(h, num, w, source_dist, memory_limit, pad="FDK" not in recon_params.algorithm)
+        print("Slab mode: %d slabs of %d slices" % (len(slabs), slabs[0][1] - slabs[0][0]))
+
+        tmp_dir = self.scan.path.parent / Path("cache")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=str(tmp_dir)) as tmp:
+            volume = np.lib.format.open_memmap(str(Path(tmp) / Path("volume.npy")), mode='w+', dtype=np.float32, shape=(h, w, w))
+
+            for z0, z1, e0, e1, r0, r1 in slabs:
+                slab = self.reconstruct_subset(projections_raw, angles, shift, source_dist, r0, r1, (e1 - e0, w, w),
+                                               (-w / 2, w / 2, -w / 2, w / 2, e0 - h / 2, e1 - h / 2))
+                volume[z0:z1] = slab[z0 - e0:z1 - e0]
+                volume.flush()
+                print("Reconstructed slices %d to %d (rows %d to %d)" % (z0, z1 - 1, r0, r1 - 1))
+                del slab
+
+            # Export to disk
+
+            self.save(volume)
+            del volume
+
+    def reconstruct_subset(self, projections_raw, angles, shift, source_dist, r0, r1, shape, window, iterations=None, init=None):
+        """
+        Reconstruct part of the volume from a subset of detector rows
+        :param projections_raw: numpy array in (rows, angles, cols) layout
+        :param angles: projection angles in radians
+        :param shift: axis shift in pixels
+        :param source_dist: distance of the source from the rotation axis in pixels
+        :param r0: first detector row
+        :param r1: last detector row + 1
+        :param shape: volume size (slices, rows, cols)
+        :param window: region covered by the volume (minx, maxx, miny, maxy, minz, maxz) relative to the center of the full volume
+        :param iterations: number of iterations (default: ReconstructionParameters.alg_iterations)
+        :param init: initial volume of the given shape for iterative algorithms (default: zero)
+        :return: float32 numpy array of the given shape
+        """
+        recon_params = self.scan.reconstruction_parameters
+        h, num, w = projections_raw.shape
+
+        # Detector of the row subset is moved to the center of the rows
+        projection_geometry = astra.create_proj_geom('cone', 1, 1, r1 - r0, w, angles, source_dist, 0)
+        projection_geometry_corrected = astra.geom_postalignment(projection_geometry, [-shift, (r0 + r1 - h) / 2])
+        volume_geometry = astra.create_vol_geom(shape[1], shape[2], shape[0], *window)
+
+        projections = np.ascontiguousarray(projections_raw[r0:r1], dtype=np.float32)
+        volume = np.array(init, dtype=np.float32) if init is not None else np.zeros(shape, dtype=np.float32)
+        projections_id = astra.data3d.link('-proj3d', projection_geometry_corrected, projections)
+        reconstruction_id = astra.data3d.link('-vol', volume_geometry, volume)
+
+        algorithm_cfg = astra.astra_dict(recon_params.algorithm)
+        algorithm_cfg['ProjectionDataId'] = projections_id
+        algorithm_cfg['ReconstructionDataId'] = reconstruction_id
+        algorithm_id = astra.algorithm.create(algorithm_cfg)
+        astra.algorithm.run(algorithm_id, iterations if iterations is not None else recon_params.alg_iterations)
 
         astra.algorithm.delete(algorithm_id)
         astra.data3d.delete(reconstruction_id)
         astra.data3d.delete(projections_id)
+        return volume
+
+
+class ReconFDKCPU(ReconstructionProvider):
+
+    """
+    Implementation of 3D cone beam reconstruction (Feldkamp-Davis-Kress) on the CPU, no GPU required (see fdk)
+    """
+
+    def __init__(self, scan : scandata.CTScan):
+        super().__init__(scan)
+
+    def reconstruct(self):
+        recon_params = self.scan.reconstruction_parameters
+        geo_scan = self.scan.processing_parameters
+
+        angles = self.scan.get_reached_angles_rad()
+
+        # Load projections into numpy array
+        projections_raw = self.scan.load_projections(recon_params.in_name, downsample=geo_scan.downsample)
+        h, num, w = projections_raw.shape
+        print(w, num, h)
+
+        shift, source_dist = self.get_geometry()
+
+        roi = self.get_roi(h, w)
+        shape, window = roi if roi is not None else (None, None)
+
+        reconstructed = fdk.reconstruct(projections_raw, angles, source_dist, shift, workers=recon_params.workers,
+                                        slab_size=recon_params.slab_size, tmp_dir=self.scan.path.parent / Path("cache"),
+                                        vol_shape=shape, window=window)
+
+        # Export to disk
+
+        self.save(reconstructed)
+
+
+def _get_npy_path(arr, tmp_dir):
+    """
+    Get .npy file containing an array, so worker processes can memory map it instead of receiving a copy
+    :param arr: numpy array (memory mapped .npy files are used directly)
+    :param tmp_dir: folder for saving arrays that aren't files yet
+    :return: path of .npy file
+    """
+    if isinstance(arr, np.memmap) and arr.filename and str(arr.filename).endswith('.npy') and arr.flags['C_CONTIGUOUS']:
+        if np.load(arr.filename, mmap_mode='r').shape == arr.shape:
+            return str(arr.filename)
+
+    path = str(Path(tmp_dir) / Path("projections.npy"))
+    np.save(path, np.asarray(arr, dtype=np.float32))
+    return path
+
+
+def _reconstruct_rows(job):
+    """
+    Reconstruct detector rows as independent 2D slices and write them into the output volume.
+    Module level function, so it can be sent to worker processes
+    :param job: tuple (projections path (.npy), output volume path (.npy), list of rows, angles in radians, axis shift, ASTRA algorithm, iterations,
+                initial volume path (.npy) or None)
+    :return: number of reconstructed rows
+    """
+    in_path, out_path, rows, angles, shift, algorithm, iterations, init_path = job
+    projections = np.load(in_path, mmap_mode='r')
+    out = np.load(out_path, mmap_mode='r+')
+    init = np.load(init_path, mmap_mode='r') if init_path else None
+    h, num, w = projections.shape
+
+    proj_geom = astra.create_proj_geom('parallel', 1.0, w, np.array(angles))
+    vol_geom = astra.create_vol_geom(w, w)
+    projector_id = astra.create_projector('linear', proj_geom, vol_geom)
+    sinogram_id = astra.data2d.create('-sino', proj_geom, 0)
+    reconstruction_id = astra.data2d.create('-vol', vol_geom, 0)
+
+    algorithm_cfg = astra.astra_dict(algorithm)
+    algorithm_cfg['ProjectorId'] = projector_id
+    algorithm_cfg['ProjectionDataId'] = sinogram_id
+    algorithm_cfg['ReconstructionDataId'] = reconstruction_id
+    algorithm_id = astra.algorithm.create(algorithm_cfg)
+
+    # The CPU algorithms only support the basic parallel geometry, so the detector is shifted by interpolation instead of postalignment
+    sinograms = np.array(projections[rows[0]:rows[-1]+1], dtype=np.float32)
+    if shift != 0:
+        sinograms = scipy.ndimage.shift(sinograms, (0, 0, -shift), order=1, mode='nearest')
+
+    for k, r in enumerate(rows):
+        astra.data2d.store(sinogram_id, sinograms[r - rows[0]])
+        astra.data2d.store(reconstruction_id, np.ascontiguousarray(init[r][::-1]) if init is not None else 0)
+        astra.algorithm.run(algorithm_id, iterations)
+        # Image rows of 2D volumes run against the y axis of 3D volumes
+        out[r] = astra.data2d.get_shared(reconstruction_id)[::-1]
+
+    out.flush()
+    astra.algorithm.delete(algorithm_id)
+    astra.data2d.delete([sinogram_id, reconstruction_id])
+    astra.projector.delete(projector_id)
+    return len(rows)
+
+
+class ReconAstra2DRows(ReconstructionProvider):
+
+    """
+    Reconstruction of every detector row as independent 2D slice (parallel beam) using the ASTRA CPU algorithms
+    FBP, SIRT and SART. Valid if the cone angle is small (large dist_source_origin). Rows are spread across a pool of
+    worker processes, which read the projections from a memory mapped file and write into a memory mapped output volume
+    """
+
+    def __init__(self, scan : scandata.CTScan):
+        super().__init__(scan)
+
+    def reconstruct(self):
+        recon_params = self.scan.reconstruction_parameters
+        geo_scan = self.scan.processing_parameters
+
+        angles = [float(a) for a in self.scan.get_reached_angles_rad()]
+
+        # Load projections into numpy array
+        projections_raw = self.scan.load_projections(recon_params.in_name, downsample=geo_scan.downsample)
+        h, num, w = projections_raw.shape
+        print(w, num, h)
+
+        if recon_params.roi:
+            raise Exception("Region of interest is not supported by row by row reconstruction")
+        if recon_params.multires and recon_params.algorithm == "FBP":
+            raise Exception("Multi-resolution reconstruction requires an iterative algorithm")
+
+        shift, source_dist = self.get_geometry()
+        print("Cone angle: %f° (ignored)" % np.rad2deg(np.arctan(np.hypot(h, w) / 2 / source_dist)))
+
+        tmp_dir = self.scan.path.parent / Path("cache")
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=str(tmp_dir)) as tmp:
+            if recon_params.multires:
+                solve = lambda projections, factor, iterations, init: reconstruct_rows(
+                    projections, angles, shift / factor, recon_params.algorithm, iterations, tmp, recon_params.workers, recon_params.slab_size, init)
+                reconstructed = self.reconstruct_multires(solve)
+            else:
+                reconstructed = reconstruct_rows(projections_raw, angles, shift, recon_params.algorithm, recon_params.alg_iterations,
+                                                 tmp, recon_params.workers, recon_params.slab_size)
+
+            # Export to disk
+
+            self.save(reconstructed)
+            del reconstructed
+
+
+def reconstruct_rows(projections, angles, shift, algorithm, iterations, tmp_dir, workers=None, slab_size=8, init=None):
+    """
+    Reconstruct every detector row as independent 2D slice in a pool of worker processes
+    :param projections: numpy array in (rows, angles, cols) layout
+    :param angles: projection angles in radians
+    :param shift: axis shift in pixels
+    :param algorithm: ASTRA CPU algorithm ("FBP", "SIRT" or "SART")
+    :param iterations: number of iterations (SART: passes over all projections)
+    :param tmp_dir: folder for temporary files, has to exist as long as the result is used
+    :param workers: number of worker processes (default: number of CPUs)
+    :param slab_size: number of rows per job
+    :param init: initial volume in (slices, rows, cols) layout for iterative algorithms (default: zero)
+    :return: float32 numpy array in (slices, rows, cols) layout (memory map in tmp_dir)
+    """
+    h, num, w = projections.shape
+    angles = [float(a) for a in angles]
+    tmp = tempfile.mkdtemp(dir=str(tmp_dir))
+
+    # SART updates the volume with a single projection per iteration
+    if algorithm == "SART":
+        iterations = iterations * num
+
+    in_path = _get_npy_path(projections, tmp)
+    out_path = str(Path(tmp) / Path("volume.npy"))
+    np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(h, w, w)).flush()
+    init_path = None
+    if init is not None:
+        init_path = str(Path(tmp) / Path("init.npy"))
+        np.save(init_path, np.asarray(init, dtype=np.float32))
+
+    slab_size = max(1, int(slab_size))
+    jobs = [(in_path, out_path, list(range(start, min(start + slab_size, h))), angles, float(shift), algorithm, iterations, init_path)
+            for start in range(0, h, slab_size)]
+    with multiprocessing.Pool(workers) as pool:
+        done = 0
+        for count in pool.imap_unordered(_reconstruct_rows, jobs):
+            done += count
+            print("Reconstructed %d/%d rows" % (done, h))
+
+    return np.load(out_path, mmap_mode='r+')
+
+
+def create_provider(scan : scandata.CTScan):
+    """
+    Create reconstruction provider for the algorithm selected in the reconstruction parameters
+    :param scan: scan to be reconstructed
+    :return: ReconstructionProvider
+    """
+    if scan.reconstruction_parameters.algorithm == "FDK_CPU":
+        return ReconFDKCPU(scan)
+    if scan.reconstruction_parameters.algorithm in row_algorithms:
+        return ReconAstra2DRows(scan)
+    return ReconAstra3DCone(scan)
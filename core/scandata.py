@@ -1,14 +1,42 @@
+import multiprocessing
 from pathlib import Path
 
 import PIL
 import numpy as np
 
-from core import processing, fsimage, fsutil
+from core import processing, fsimage, fsutil, fsstack, pipeline, statistics, calibration, alignment, profiling
 import cv2
 import matplotlib.pyplot as plt
 
 # All measurements in mm or px
 
+def _decode_batch(job):
+    """
+    Decode and crop a batch of projections
+    :param job: tuple (scan folder path, list of projection indices, crop region (x, y, x2, y2), processing parameters, processing stack)
+    :return: tuple (job, cropped raw numpy array of shape (N, H, W))
+    """
+    path_str, indices, region, params, stack = job
+    arr = np.stack([fsimage.load_projection(path_str, i, cache_limit=params.cache_limit, backend=params.decode_backend, roi=region) for i in indices])
+    return job, arr
+
+def _execute_batch(decoded):
+    """
+    Run decoded batch of projections through the processing stack
+    :param decoded: tuple (job, cropped raw numpy array) as returned by _decode_batch
+    :return: tuple (list of projection indices, processed numpy array of shape (N, H, W))
+    """
+    job, arr = decoded
+    return job[1], job[4].execute_batch(arr, auto=False, mode=job[3].stack_mode)
+
+def _process_batch(job):
+    """
+    Decode, crop and process a batch of projections. Module level function, so it can be sent to worker processes
+    :param job: tuple (scan folder path, list of projection indices, crop region (x, y, x2, y2), processing parameters, processing stack)
+    :return: tuple (list of projection indices, processed numpy array of shape (N, H, W))
+    """
+    return _execute_batch(_decode_batch(job))
+
 class ReconstructionParameters:
     def __init__(self):
         self.dist_source_origin = 10000
@@ -16,9 +44,22 @@ class ReconstructionParameters:
         self.axis_adj = 0
         self.in_name = "full"
         self.out_name = "recon"
-        self.algorithm = "SIRT3D_CUDA"
+        self.algorithm = "SIRT3D_CUDA" # ASTRA 3D algorithm, "FDK_CPU" or row by row ASTRA 2D CPU algorithm "FBP", "SIRT" or "SART" (see reconstruction.create_provider)
         self.alg_iterations = 100
+        self.workers = None # number of processes used by CPU reconstruction (None = number of CPUs)
+        self.slab_size = 8 # number of slices reconstructed per job by CPU reconstruction
+        self.memory_limit = 0 # memory limit of ASTRA cone beam reconstruction in MB, larger volumes are reconstructed in slabs (0 = no limit).
+                              # Projections are memory mapped and read slab by slab only with ProcessingParameters.out_format "stack"
+                              # (and downsample_cache when downsampling), TIFF series are loaded completely.
+                              # Not supported by multires, a region of interest (roi) is reconstructed at once
+        self.roi = None # region of interest [x, y, z, x2, y2, z2] in pixels of the cropped projections (x: cols, y: depth, z: rows), None = whole field of view.
+                        # Iterative algorithms don't model material outside the region, FDK is recommended
+        self.multires = [] # coarse to fine schedule of iterative reconstruction: [[downsample factor relative to ProcessingParameters.downsample, iterations], ...],
+                           # e.g. [[4, 40], [2, 20], [1, 10]]. Empty = single level with alg_iterations
+        self.roi_voxel_size = 1.0 # voxel size of the region of interest in pixels of the cropped projections (independent of downsample)
         self.high_output = 1
+        self.out_format = "series" # "series" (one TIFF file per slice) or "multipage" (single BigTIFF file)
+        self.out_compression = None # compression of multi-page output (e.g. "zlib")
 
 class ProcessingParameters:
     def __init__(self):
@@ -28,6 +69,20 @@ class ProcessingParameters:
         self.dist_reference = 150
         self.downsample = 4
         self.out_name = "full"
+        self.batch_mode = "pipeline" # "serial", "pool" or "pipeline" (see CTScan.process_all)
+        self.workers = 1 # number of processes used by CTScan.process_all in pool mode
+        self.pipeline_workers = [2, 1, 1] # number of threads for decoding, processing and writing in pipeline mode
+        self.pipeline_queue = 4 # maximum number of batches waiting in front of each pipeline stage
+        self.batch_size = 16 # number of projections processed at once by CTScan.process_all
+        self.calib_method = "median" # combination of calibration captures into master frames: "median" or "mean"
+        self.auto_percentiles = {} # limits set by CTScan.auto_parameters: {processor name: [low percentile, high percentile]}
+        self.stack_mode = "lut" # "default" (ProcessingStack.execute), "compiled" (in place, see processing.CompiledStack) or "lut" (lookup table for 16 bit input)
+        self.downsample_mode = "lanczos" # "lanczos" (interpolation) or "bin" (block mean, integer factors only)
+        self.downsample_cache = True # keep downsampled projections in proj/cache
+        self.out_format = "stack" # "stack" (single memory mapped file, see fsstack) or "tiff" (series of TIFF files)
+        self.cache_limit = 2048 # size limit of decoded projection cache in MB (0 = disabled)
+        self.decode_backend = "postprocess" # raw decoder: "postprocess" (LibRaw) or "bayer" (green photosites of bayer mosaic)
+        self.profile = False # record time and memory of every processor call in CTScan.process_all (proj/<out_name>_profile.json/.csv)
 
     def get_center(self):
         half = self.coords_align[2]/2
@@ -75,38 +130,188 @@ class CTScan:
         self.target_angles = [(self.scan_max_angle / self.num_projections) * i for i in range(self.num_projections)]
         self.reached_angles = []
 
-    def process_all(self):
-        center_x = self.processing_parameters.get_center()[0]
-        center_y = self.processing_parameters.get_center()[1]
-        # Calculate image region
+    def get_crop_region(self):
+        """
+        Calculate the image region that is cut out of every projection
+        :return: (x, y, x2, y2) rounded pixel coordinates
+        """
+        center_x, center_y = self.processing_parameters.get_center()
         x = center_x - self.processing_parameters.coords_crop[0]/2
         y = center_y - self.processing_parameters.coords_crop[1]/2
         x2 = center_x + self.processing_parameters.coords_crop[0]/2
         y2 = center_y + self.processing_parameters.coords_crop[1]/2
+        return round(x), round(y), round(x2), round(y2)
+
+    def process_all(self):
+        """
+        Decode, crop and process all projections and save them as projection stack proj/<out_name>.npy or as TIFF series proj/<out_name>NNNN.tiff
+        processing_parameters.batch_mode selects how the work is distributed:
+        "serial": one projection after another, "pool": pool of worker processes, "pipeline": concurrent decode/process/write stages
+        """
+        path_str = str(self.path.parent)
+        region = self.get_crop_region()
+        out_path = str(self.path.parent / Path("proj/" + str(self.processing_parameters.out_name) + ".tiff"))
+
+        self.processing_stack.enable_all()
+        self.processing_stack.set_region(region)
+        #self.processing_stack.disable_all()
+        #self.processing_stack.enable_list(['normalize_raw'])
+
+        # Projections are processed in batches, so every numpy operation of the processing stack works on multiple projections at once
+        batch_size = max(1, int(self.processing_parameters.batch_size))
+        jobs = [(path_str, list(range(start, min(start + batch_size, self.num_projections))), region, self.processing_parameters, self.processing_stack)
+                for start in range(0, self.num_projections, batch_size)]
+        mode = self.processing_parameters.batch_mode
+
+        if self.processing_parameters.out_format == "stack":
+            header = {'angles': self.get_reached_angles_rad(), 'processing_parameters': dict(self.processing_parameters.__dict__)}
+            self.processing_stack.to_dict('processing_stack', header)
+            writer = fsstack.StackWriter(fsstack.get_stack_path(path_str, self.processing_parameters.out_name), self.num_projections, header)
+            save = writer.write
+        else:
+            writer = None
+            save = lambda i, arr: fsutil.save_np_as_img(arr, out_path, num=i)
+
+        def save_batch(indices, arr):
+            for k, i in enumerate(indices):
+                save(i, arr[k])
+
+        profiler = None
+        if self.processing_parameters.profile:
+            if mode == "pool":
+                print("Profiling warning: calls in worker processes are not recorded")
+            profiler = profiling.StackProfiler()
+            self.processing_stack.profiler = profiler
+
+        try:
+            if mode == "pipeline":
+                # Decoding, processing and writing run concurrently, connected by bounded queues
+                decode_workers, process_workers, write_workers = self.processing_parameters.pipeline_workers
+                proc_pipeline = pipeline.Pipeline(self.processing_parameters.pipeline_queue)
+                proc_pipeline.add_stage("decode", _decode_batch, decode_workers)
+                proc_pipeline.add_stage("process", _execute_batch, process_workers)
+                proc_pipeline.add_stage("write", lambda res: save_batch(*res), write_workers)
+                proc_pipeline.run(jobs)
+                proc_pipeline.print_stats()
+            elif mode == "pool":
+                with multiprocessing.Pool(int(self.processing_parameters.workers)) as pool:
+                    # imap keeps the order of the batches, so the images are written in order while the pool keeps decoding
+                    for indices, arr in pool.imap(_process_batch, jobs):
+                        save_batch(indices, arr)
+            else:
+                for job in jobs:
+                    save_batch(*_process_batch(job))
+
+            if writer is not None:
+                writer.close()
+        finally:
+            if profiler is not None:
+                # Stop memory tracing and detach the profiler even if a batch failed
+                profiler.stop()
+                self.processing_stack.profiler = None
+
+        if profiler is not None:
+            profiler.print_summary()
+            profile_path = self.path.parent / Path("proj/" + str(self.processing_parameters.out_name) + "_profile.json")
+            profiler.export_json(profile_path)
+            profiler.export_csv(profile_path.with_suffix(".csv"))
+
+    def build_master_frames(self):
+        """
+        Build master dark and flat frames from the calibration captures (see calibration) and enable flat-field correction
+        """
+        workers = int(self.processing_parameters.workers) if self.processing_parameters.workers > 1 else None
+        masters = {}
+        for kind in ("dark", "flat"):
+            masters[kind] = calibration.build_master(self.path.parent, kind, method=self.processing_parameters.calib_method,
+                                                     backend=self.processing_parameters.decode_backend, workers=workers)
+
+        flatfield = self.processing_stack.get_processor("flatfield")
+        flatfield.dark_path = str(masters["dark"])
+        flatfield.flat_path = str(masters["flat"])
+
+    def build_defect_map(self, threshold=6.0):
+        """
+        Find defect pixels from per pixel statistics of all projections, save the map to cache/defects.npy and enable defect pixel repair
+        :param threshold: allowed deviation from the neighborhood in robust standard deviations
+        :return: bool numpy array, True for defect pixels
+        """
+        workers = int(self.processing_parameters.workers) if self.processing_parameters.workers > 1 else None
+        stats = statistics.collect_pixel_statistics(self, workers=workers)
+        defects = statistics.find_defects(stats, threshold=threshold)
+
+        map_path = self.path.parent / Path("cache/defects.npy")
+        map_path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(str(map_path), defects)
 
-        for i in range(self.num_projections): #self.num_projections
-            raw = fsimage.load_projection_raw_pana(self.path.parent, i)
-
-            #TODO alle dateien sauber packagen + RAW bilder dazu packen
-            print(raw.dtype)
-            arr = raw[round(y):round(y2),round(x):round(x2)]
-
-            self.processing_stack.enable_all()
-            #self.processing_stack.disable_all()
-            #self.processing_stack.enable_list(['normalize_raw'])
-            arr = self.processing_stack.execute(arr, auto=False)
-            print(np.max(arr), np.min(arr))
-
-            print(np.max(arr))
-            print(arr.dtype)
-            #imgplt = plt.imshow(arr,cmap="gray")
-            #plt.show()
-            #cv2.imwrite("1", arr)
-            #arr *= 255
-            #arr = np.uint8(arr)
-           # cv2.imshow("2", arr)
-
-            fsutil.save_np_as_img(arr, str(self.path.parent / Path("proj/" + str(self.processing_parameters.out_name) + ".tiff")), num=i)
+        proc = self.processing_stack.get_processor("defects")
+        proc.map_path = str(map_path)
+        proc.map_region = list(self.get_crop_region())
+        print("Found %d defect pixels" % np.count_nonzero(defects))
+        return defects
+
+    def auto_parameters(self):
+        """
+        Calculate processing stack parameters (normalization and optionally limits) from the statistics of all projections,
+        so that batch processing doesn't depend on the projection that was previewed. Parameters behind processors that
+        aren't pointwise (e.g. flat-field correction) are calculated from projections run through the stack up to there
+        :return: statistics of the input of the last processor that needed statistics (None if no processor needs statistics)
+        """
+        workers = int(self.processing_parameters.workers) if self.processing_parameters.workers > 1 else None
+        percentiles = self.processing_parameters.auto_percentiles
+        stats = None
+        stage = statistics.get_stats_stage(self.processing_stack, 0, percentiles)
+        while stage is not None:
+            stats = statistics.collect_statistics(self, workers=workers, stop=stage)
+            print("Scan statistics (input of %s): min %f, max %f, mean %f" % (self.processing_stack.processors_name[stage], stats.get_min(), stats.get_max(), stats.get_mean()))
+            stage = statistics.fill_stack_parameters(self.processing_stack, stats, percentiles, start=stage)
+        return stats
+
+    def auto_axis(self, name=None, pairs=4):
+        """
+        Find rotation axis in the downsampled processed projections and move coords_axis there
+        :param name: name of processed projections (default: ProcessingParameters.out_name)
+        :param pairs: number of opposite projection pairs used
+        :return: axis shift relative to the center of the projections in downsampled pixels (see ProcessingParameters.get_shift_x)
+        """
+        params = self.processing_parameters
+        projections = self.load_projections(name if name else params.out_name, downsample=params.downsample)
+        angles = self.reached_angles if len(self.reached_angles) == projections.shape[1] else \
+            [(self.scan_max_angle / projections.shape[1]) * i for i in range(projections.shape[1])]
+
+        axis = alignment.find_axis(projections, angles, pairs)
+        # Projections are cropped symmetrically around the center of the calibration circle
+        shift = axis - (projections.shape[2] - 1) / 2
+        params.coords_axis[0] = params.get_center()[0] + shift * params.downsample - params.coords_axis[2] / 2
+        print("Axis Shift: %f" % params.get_shift_x())
+        return params.get_shift_x()
+
+    def load_projections(self, name, downsample=None):
+        """
+        Load processed projections. The projection stack file is used if it exists, otherwise the TIFF series.
+        Downsampled projections are cached in proj/cache until the source projections change. Projection stacks are
+        returned as memory map (downsampled ones only with the cache enabled), TIFF series are loaded into memory
+        :param name: name of processed projections
+        :param downsample: downsampling factor
+        :return: float32 numpy array in (rows, angles, cols) layout
+        """
+        mode = self.processing_parameters.downsample_mode
+        stack_path = fsstack.get_stack_path(self.path.parent, name)
+        tiff_path = self.path.parent / Path("proj/" + name + ".tiff")
+
+        if self.processing_parameters.out_format == "stack" and fsstack.stack_exists(stack_path):
+            sources = [stack_path, stack_path.with_suffix(fsstack.header_ext)]
+            loader = lambda out_path: fsstack.load_stack_downsample(stack_path, downsample, mode, out_path=out_path)
+        else:
+            sources = fsutil.find_numbered(tiff_path)
+            loader = lambda out_path: fsutil.load_img_as_np(str(tiff_path), stackaxis=1, downsample=downsample, mode=mode)
+
+        if not downsample or downsample == 1 or not self.processing_parameters.downsample_cache:
+            return loader(None)
+
+        cache_path = self.path.parent / Path("proj/cache/%s_ds%s_%s.npy" % (name, downsample, mode))
+        key = {'downsample': downsample, 'mode': mode, 'files': fsstack.file_signature(sources)}
+        return fsstack.load_cached(cache_path, key, loader)
 
     def get_resolution(self):
         """
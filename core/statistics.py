@@ -0,0 +1,406 @@
+import multiprocessing
+
+import numpy as np
+import scipy.ndimage
+
+from core import fsimage, processing
+
+"""
+Scan wide statistics of the raw projections. The values of the cropped raw projections are 16 bit, so an exact histogram
+with one bin per value is a small, mergeable accumulator: every worker collects the histogram of some projections,
+the histograms are added up and min, max and percentiles of the whole scan are read from the result.
+Projections are streamed through the workers and never held in memory together.
+Processors that aren't pointwise (e.g. flat-field correction) don't map values to values, so the statistics behind
+them are collected from projections that were run through the stack up to that point, with a histogram of float values.
+Per pixel statistics (temporal mean and variance) are collected the same way for building defect pixel maps.
+"""
+
+hist_size = 65536
+
+
+class HistogramStats:
+    """
+    Mergeable accumulator for 16 bit data
+    """
+
+    def __init__(self):
+        self.hist = np.zeros(hist_size, dtype=np.int64)
+
+    def add(self, arr: np.ndarray):
+        """
+        Add values to the histogram
+        :param arr: uint16 numpy array
+        """
+        self.hist += np.bincount(arr.ravel(), minlength=hist_size)
+
+    def merge(self, other):
+        """
+        Add values of another accumulator
+        :param other: HistogramStats
+        :return: reference to self
+        """
+        self.hist += other.hist
+        return self
+
+    def get_count(self):
+        return int(np.sum(self.hist))
+
+    def get_min(self):
+        return int(np.flatnonzero(self.hist)[0])
+
+    def get_max(self):
+        return int(np.flatnonzero(self.hist)[-1])
+
+    def get_mean(self):
+        return float(np.dot(np.arange(hist_size, dtype=np.float64), self.hist) / self.get_count())
+
+    def get_percentile(self, q):
+        """
+        :param q: percentile between 0 and 100
+        :return: smallest value that is greater or equal to q percent of all values
+        """
+        return float(weighted_percentile(np.arange(hist_size), self.hist, q))
+
+    def get_values(self):
+        """
+        :return: tuple (float32 numpy array of values, numpy array of their number of occurrences)
+        """
+        return np.arange(hist_size, dtype=np.float32), self.hist
+
+
+class FloatHistogramStats:
+    """
+    Mergeable accumulator for float32 data. Values are counted in bins given by the upper 16 bits of their float32
+    representation, which keeps a relative precision of 0.4% at every magnitude. Min, max and mean are exact
+    """
+
+    # Center of every bin (bins of infinity and NaN keep their value)
+    bin_values = np.where(np.arange(hist_size) & 0x7F80 == 0x7F80, np.arange(hist_size, dtype=np.uint32) << 16,
+                          np.arange(hist_size, dtype=np.uint32) << 16 | 0x8000).astype(np.uint32).view(np.float32)
+
+    def __init__(self):
+        self.hist = np.zeros(hist_size, dtype=np.int64)
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.0
+
+    @staticmethod
+    def get_bin(arr):
+        """
+        :param arr: numpy array or scalar
+        :return: bin indices of the values
+        """
+        return np.ascontiguousarray(arr, dtype=np.float32).view(np.uint32) >> 16
+
+    def add(self, arr: np.ndarray):
+        """
+        Add values to the histogram
+        :param arr: numpy array
+        """
+        arr = np.asarray(arr, dtype=np.float32)
+        self.hist += np.bincount(self.get_bin(arr).ravel(), minlength=hist_size)
+        finite = arr[np.isfinite(arr)]
+        if finite.size:
+            self.min = min(self.min, float(np.min(finite)))
+            self.max = max(self.max, float(np.max(finite)))
+            self.sum += float(np.sum(finite, dtype=np.float64))
+
+    def merge(self, other):
+        """
+        Add values of another accumulator
+        :param other: FloatHistogramStats
+        :return: reference to self
+        """
+        self.hist += other.hist
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.sum += other.sum
+        return self
+
+    def get_count(self):
+        return int(np.sum(self.hist))
+
+    def get_min(self):
+        return self.min
+
+    def get_max(self):
+        return self.max
+
+    def get_mean(self):
+        return self.sum / max(int(np.sum(self.hist[np.isfinite(self.bin_values)])), 1)
+
+    def get_percentile(self, q):
+        """
+        :param q: percentile between 0 and 100
+        :return: smallest value that is greater or equal to q percent of all values (bin center)
+        """
+        values, weights = self.get_values()
+        return float(weighted_percentile(values, weights, q))
+
+    def get_values(self):
+        """
+        :return: tuple (float32 numpy array of bin centers limited to min and max, numpy array of their number of occurrences)
+                 of all present bins. Min and max of the values are exact
+        """
+        values = self.bin_values.copy()
+        weights = self.hist.copy()
+        if self.min <= self.max:
+            # Bin centers may lie outside the range of the values they represent, the bins of min and max represent them exactly
+            finite = np.isfinite(values)
+            values[finite] = np.clip(values[finite], np.float32(self.min), np.float32(self.max))
+            low, high = self.get_bin(np.array([self.min, self.max], dtype=np.float32))
+            values[low] = self.min
+            if low == high and self.min != self.max:
+                weights[low] -= 1
+                values = np.append(values, np.float32(self.max))
+                weights = np.append(weights, 1)
+            else:
+                values[high] = self.max
+
+        present = weights > 0
+        return values[present], weights[present]
+
+
+class PixelStats:
+    """
+    Mergeable accumulator for the temporal mean and variance of every pixel (Welford's algorithm)
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, arr: np.ndarray):
+        """
+        Add single image
+        :param arr: 2D numpy array
+        """
+        if self.mean is None:
+            self.mean = np.zeros(arr.shape, dtype=np.float64)
+            self.m2 = np.zeros(arr.shape, dtype=np.float64)
+        self.n += 1
+        delta = arr - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (arr - self.mean)
+
+    def merge(self, other):
+        """
+        Add images of another accumulator (Chan et al. parallel algorithm)
+        :param other: PixelStats
+        :return: reference to self
+        """
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n, self.mean, self.m2 = other.n, other.mean.copy(), other.m2.copy()
+            return self
+
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * (other.n / n)
+        self.m2 += other.m2 + delta ** 2 * (self.n * other.n / n)
+        self.n = n
+        return self
+
+    def get_variance(self):
+        return self.m2 / max(self.n - 1, 1)
+
+
+def find_defects(stats: PixelStats, threshold=6.0, size=5, white_level=None):
+    """
+    Flag pixels whose temporal mean or standard deviation differs strongly from their neighborhood (dust, dead and hot pixels).
+    Pixels that never change are flagged as dead, unless they are clipped at the white level (saturated by the unattenuated beam)
+    :param stats: per pixel statistics of all projections
+    :param threshold: allowed deviation in units of the robust standard deviation (median absolute deviation)
+    :param size: size of the neighborhood
+    :param white_level: clipping value of the sensor (default: highest mean of all pixels)
+    :return: bool numpy array, True for defect pixels
+    """
+    # Clipped pixels have no noise, they are left out of the noise estimate and their temporal noise is meaningless
+    saturated = stats.mean >= (np.max(stats.mean) if white_level is None else white_level)
+    if np.all(saturated):
+        return np.zeros(saturated.shape, dtype=bool)
+
+    def outliers(img):
+        residual = img - scipy.ndimage.median_filter(img, size=size, mode='nearest')
+        mad = np.median(np.abs(residual[~saturated])) * 1.4826
+        return np.abs(residual) > threshold * max(mad, 1e-12)
+
+    std = np.sqrt(stats.get_variance())
+    return outliers(stats.mean) | ((outliers(std) | (std == 0)) & ~saturated)
+
+
+def weighted_percentile(values, weights, q):
+    """
+    Percentile of values that occur with the given frequency
+    :param values: numpy array of values
+    :param weights: numpy array of number of occurrences of each value
+    :param q: percentile between 0 and 100
+    :return: percentile value
+    """
+    valid = (weights > 0) & np.isfinite(values)
+    values = values[valid]
+    weights = weights[valid]
+    order = np.argsort(values, kind='stable')
+    cumulative = np.cumsum(weights[order])
+    idx = np.searchsorted(cumulative, cumulative[-1] * q / 100.0)
+    return values[order][min(idx, len(values) - 1)]
+
+
+def _stats_worker(job):
+    """
+    Collect statistics of some projections. Module level function, so it can be sent to worker processes
+    :param job: tuple (scan folder path, list of projection indices, crop region (x, y, x2, y2), processing parameters,
+                processing stack, number of processors the projections are run through)
+    :return: HistogramStats of the raw data or FloatHistogramStats of the processed data
+    """
+    path_str, indices, region, params, stack, stop = job
+    if stop == 0:
+        stats = HistogramStats()
+        for i in indices:
+            stats.add(fsimage.load_projection(path_str, i, cache_limit=params.cache_limit, backend=params.decode_backend, roi=region))
+        return stats
+
+    stack.set_region(region)
+    arr = np.stack([fsimage.load_projection(path_str, i, cache_limit=params.cache_limit, backend=params.decode_backend, roi=region)
+                    for i in indices]).astype(np.float32)
+    for i in range(stop):
+        if stack.processors_enable[i]:
+            arr = stack.processors[i].process_static(arr)
+
+    stats = FloatHistogramStats()
+    stats.add(arr)
+    return stats
+
+
+def collect_statistics(scan, workers=None, chunk=8, stop=0):
+    """
+    Collect statistics of all projections of a scan in parallel
+    :param scan: CTScan
+    :param workers: number of worker processes (default: number of CPUs)
+    :param chunk: number of projections per job
+    :param stop: number of processors of the scan's processing stack the projections are run through (static settings). 0 = cropped raw data
+    :return: HistogramStats of the raw data (stop = 0) or FloatHistogramStats of the processed data
+    """
+    path_str = str(scan.path.parent)
+    region = scan.get_crop_region()
+    jobs = [(path_str, list(range(start, min(start + chunk, scan.num_projections))), region, scan.processing_parameters,
+             scan.processing_stack if stop else None, stop)
+            for start in range(0, scan.num_projections, chunk)]
+
+    total = HistogramStats() if stop == 0 else FloatHistogramStats()
+    with multiprocessing.Pool(workers) as pool:
+        for stats in pool.imap_unordered(_stats_worker, jobs):
+            total.merge(stats)
+    return total
+
+
+def _pixel_stats_worker(job):
+    """
+    Collect per pixel statistics of some projections. Module level function, so it can be sent to worker processes
+    :param job: tuple (scan folder path, list of projection indices, crop region (x, y, x2, y2), processing parameters)
+    :return: PixelStats
+    """
+    path_str, indices, region, params = job
+    stats = PixelStats()
+    for i in indices:
+        stats.add(fsimage.load_projection(path_str, i, cache_limit=params.cache_limit, backend=params.decode_backend, roi=region))
+    return stats
+
+
+def collect_pixel_statistics(scan, workers=None, chunk=8):
+    """
+    Collect per pixel statistics of the cropped raw data of all projections of a scan in parallel
+    :param scan: CTScan
+    :param workers: number of worker processes (default: number of CPUs)
+    :param chunk: number of projections per job
+    :return: PixelStats of the whole scan
+    """
+    path_str = str(scan.path.parent)
+    region = scan.get_crop_region()
+    jobs = [(path_str, list(range(start, min(start + chunk, scan.num_projections))), region, scan.processing_parameters)
+            for start in range(0, scan.num_projections, chunk)]
+
+    total = PixelStats()
+    with multiprocessing.Pool(workers) as pool:
+        for stats in pool.imap_unordered(_pixel_stats_worker, jobs):
+            total.merge(stats)
+    return total
+
+
+def _needs_stats(stack, i, percentiles):
+    """
+    :return: bool if processor i of the stack gets parameters from the statistics
+    """
+    proc = stack.processors[i]
+    if stack.processors_name[i] in percentiles and hasattr(proc, 'low_limit'):
+        return True
+    return isinstance(proc, processing.NormalizeProc) and (proc.min is not None or proc.max is not None)
+
+
+def get_stats_stage(stack, start=0, percentiles=None):
+    """
+    Find the processor whose input values the statistics for fill_stack_parameters have to be collected from.
+    Pointwise processors in front of the first processor needing statistics are evaluated on the statistics themselves,
+    the other processors have to be run on the projections (see collect_statistics)
+    :param stack: processing stack
+    :param start: index of first processor that still needs statistics
+    :param percentiles: dict {processor name: [low percentile, high percentile]} (see fill_stack_parameters)
+    :return: processor index or None if no processor from start on needs statistics
+    """
+    percentiles = percentiles if percentiles else {}
+    stage = start
+    for i in range(start, len(stack.processors)):
+        if not stack.processors_enable[i]:
+            continue
+        if _needs_stats(stack, i, percentiles):
+            return stage
+        if not stack.processors[i].pointwise:
+            stage = i + 1
+    return None
+
+
+def fill_stack_parameters(stack, stats, percentiles=None, start=0):
+    """
+    Set processor parameters like process_auto would if the whole scan was one image.
+    Every value is passed through the stack together with its frequency, so no projection has to be processed again.
+    This stops at the first processor that isn't pointwise, the remaining parameters need statistics collected behind it
+    (FloatHistogramStats, percentiles are precise to 0.4% of the values at the stage where they were collected):
+        stage = get_stats_stage(stack, 0, percentiles)
+        while stage is not None:
+            stage = fill_stack_parameters(stack, collect_statistics(scan, stop=stage), percentiles, start=stage)
+    :param stack: processing stack
+    :param stats: statistics of the values entering processor start (HistogramStats or FloatHistogramStats)
+    :param percentiles: optional dict {processor name: [low percentile, high percentile]} for setting limits. Limits not in this dict keep their values
+    :param start: index of first processor
+    :return: index of the processor whose input statistics are needed next (see get_stats_stage) or None if all parameters are set
+    """
+    percentiles = percentiles if percentiles else {}
+    values, weights = stats.get_values()
+    present = weights > 0
+
+    for i in range(start, len(stack.processors)):
+        if not stack.processors_enable[i]:
+            continue
+        proc = stack.processors[i]
+        name = stack.processors_name[i]
+
+        if not proc.pointwise:
+            return get_stats_stage(stack, i, percentiles)
+
+        if name in percentiles and hasattr(proc, 'low_limit'):
+            low, high = percentiles[name]
+            proc.low_limit = float(weighted_percentile(values, weights, low))
+            proc.high_limit = float(weighted_percentile(values, weights, high))
+
+        if isinstance(proc, processing.NormalizeProc):
+            # Same as NormalizeProc.process_auto over all values of the scan
+            if proc.min is not None:
+                proc.min = float(np.min(values[present]))
+            if proc.max is not None:
+                proc.max = float(np.max(values[present])) - (proc.min if proc.min is not None else 0)
+
+        values = proc.process_static(values)
+
+    return None
@@ -6,7 +6,7 @@ from tkinter import filedialog, messagebox
 import numpy as np
 from PIL import Image
 
-from core import scandata, processing, fsimage
+from core import scandata, processing, fsimage, fsstack
 from gui import image
 
 
@@ -54,6 +54,12 @@ class ProcessingFrame:
         self.button_proc_all = Button(self.frame_proc, text="Process All", command=self.but_proc_all)
         self.button_proc_all.pack(expand="YES", fill=BOTH)
 
+        self.button_proc_stats = Button(self.frame_proc, text="Normalize using all projections", command=self.but_proc_stats)
+        self.button_proc_stats.pack(expand="YES", fill=BOTH)
+
+        self.button_proc_defects = Button(self.frame_proc, text="Find defect pixels", command=self.but_proc_defects)
+        self.button_proc_defects.pack(expand="YES", fill=BOTH)
+
 
         self.label_out = Label(self.frame_proc, text="Output name:")
         self.label_out.pack()
@@ -81,6 +87,9 @@ class ProcessingFrame:
         self.button_load = Button(self.frame_fs, text="Load", command=self.but_load)
         self.button_load.pack(expand="YES", fill=BOTH, pady=10)
 
+        self.button_show_processed = Button(self.frame_fs, text="Show processed", command=self.but_show_processed)
+        self.button_show_processed.pack(expand="YES", fill=BOTH)
+
         self.__pic_valcmd = self.root.register(self.__validate_picnum)
 
         self.label_picnum = Label(self.frame_fs, text="Picture index:")
@@ -102,6 +111,9 @@ class ProcessingFrame:
         self.button_crop = Button(self.frame_align, text="Crop", command=self.but_crop)
         self.button_crop.pack(expand="YES", fill=BOTH)
 
+        self.button_auto_axis = Button(self.frame_align, text="Auto axis", command=self.but_auto_axis)
+        self.button_auto_axis.pack(expand="YES", fill=BOTH)
+
         self.__bind_wheel(self.entry_pre_low, 0.01)
         self.__bind_wheel(self.entry_pre_high, 0.01)
         self.__bind_wheel(self.entry_post_low, 0.01)
@@ -189,7 +201,8 @@ class ProcessingFrame:
         self.proc_prev.get_processor("limit_pre").low_limit = self.entry_pre_low.get()
         self.proc_prev.get_processor("limit_pre").high_limit = self.entry_pre_high.get()
 
-        arr = self.proc_prev.execute(self.projection, auto=True)
+        self.proc_prev.set_region(None) # preview shows the full image
+        arr = self.proc_prev.execute_cached(self.projection, auto=True) # only reruns the stages after the first changed setting
         arr *= 255
         arr = np.uint8(arr)
 
@@ -231,6 +244,42 @@ class ProcessingFrame:
         self.scan_ctx.curr_scan.process_all()
 
 
+    def but_proc_stats(self):
+        """
+        Button event handler: calculate normalization parameters from the statistics of all projections
+        """
+        if self.scan_ctx.curr_scan is None:
+            return
+
+        stack = self.scan_ctx.curr_scan.processing_stack
+        stack.get_processor("limit_post").low_limit = self.entry_post_low.get()
+        stack.get_processor("limit_post").high_limit = self.entry_post_high.get()
+        stack.get_processor("limit_pre").low_limit = self.entry_pre_low.get()
+        stack.get_processor("limit_pre").high_limit = self.entry_pre_high.get()
+        stack.enable_all()
+
+        try:
+            self.scan_ctx.curr_scan.auto_parameters()
+        except Exception as e:
+            messagebox.showerror(title="Processing error", message=str(e))
+            traceback.print_exc()
+
+    def but_proc_defects(self):
+        """
+        Button event handler: build defect pixel map from the statistics of all projections
+        """
+        if self.scan_ctx.curr_scan is None:
+            return
+
+        try:
+            self.scan_ctx.curr_scan.build_defect_map()
+        except Exception as e:
+            messagebox.showerror(title="Processing error", message=str(e))
+            traceback.print_exc()
+            return
+        if self.proc_prev is not None:
+            self.proc_prev.clear_cache()
+
     def but_changemode(self, val):
         """
         Drop down menu selection event handler: change viewer mode
@@ -242,9 +291,9 @@ class ProcessingFrame:
         self.mode_colorize = False
 
         if val == "Raw":
-            self.proc_prev.enable_list(range(0, 1))
+            self.proc_prev.enable_list(["defects", "flatfield", "normalize_raw"])
         elif val == "Exposure":
-            self.proc_prev.enable_list(range(0, 3))
+            self.proc_prev.enable_list(["defects", "flatfield", "normalize_raw", "limit_pre", "normalize_pre", "denoise_median", "denoise_bilateral", "denoise_nlmeans"])
             self.mode_colorize = True
         elif val == "Log":
             self.proc_prev.enable_all()
@@ -332,6 +381,24 @@ class ProcessingFrame:
 
 
 
+    def but_auto_axis(self):
+        """
+        Button event handler: Find rotation axis in the processed projections of the open scan
+        """
+        if self.scan_ctx.curr_scan is None or self.scan_ctx.curr_scan.path is None:
+            messagebox.showerror(title="Processing error", message="No scan loaded")
+            return
+
+        try:
+            self.scan_ctx.curr_scan.auto_axis()
+        except Exception as e:
+            messagebox.showerror(title="Processing error", message=str(e))
+            traceback.print_exc()
+            return
+
+        self.axis_coords = list(self.scan_ctx.curr_scan.processing_parameters.coords_axis)
+        self.update_overlay()
+
     def but_load(self):
         """
         Button event handler: Load specified projection
@@ -341,6 +408,7 @@ class ProcessingFrame:
             return
 
         self.proc_prev = copy.copy(self.scan_ctx.curr_scan.processing_stack) #Shallow copy ProcessingStack -> references the same processors as CTSCan.processing_stack but allows independent control over enabling/disabling
+        self.proc_prev.clear_cache()
 
         try:
             num = int(self.entry_picnum.get()) - 1
@@ -376,7 +444,7 @@ class ProcessingFrame:
 
 
         try:
-            self.projection = fsimage.load_projection_raw_pana(self.scan_ctx.curr_scan.path.parent, num)
+            self.projection = fsimage.load_projection(self.scan_ctx.curr_scan.path.parent, num, cache_limit=self.scan_ctx.curr_scan.processing_parameters.cache_limit, backend=self.scan_ctx.curr_scan.processing_parameters.decode_backend)
         except Exception as e:
             messagebox.showerror(title="Processing error", message=str(e))
             traceback.print_exc()
@@ -385,6 +453,30 @@ class ProcessingFrame:
         self.but_changemode("Raw")
 
 
+    def but_show_processed(self):
+        """
+        Button event handler: Show specified projection of the processed projection stack
+        """
+        if self.scan_ctx.curr_scan is None or self.scan_ctx.curr_scan.path is None:
+            messagebox.showerror(title="Processing error", message="No scan loaded")
+            return
+
+        try:
+            num = int(self.entry_picnum.get()) - 1
+            stack_path = fsstack.get_stack_path(self.scan_ctx.curr_scan.path.parent, self.scan_ctx.curr_scan.processing_parameters.out_name)
+            stack, header = fsstack.open_stack(stack_path, mode='r') # memory mapped, only the selected projection is read
+            if num not in range(stack.shape[1]):
+                raise Exception("Invalid projection number")
+            arr = np.clip(stack[:, num, :], 0, 1) * 255
+        except Exception as e:
+            messagebox.showerror(title="Processing error", message=str(e))
+            traceback.print_exc()
+            return
+
+        self.curr_img = Image.fromarray(np.uint8(arr))
+        self.imgcanvas.set_image(self.curr_img, reset=False)
+        self.update_overlay()
+
     def but_import(self):
         """
         Button event handler: Import images from SD-card to scan folder
@@ -133,7 +133,7 @@ class ReconstructionFrame:
             return
 
         # Create reconstruction thread
-        self.provider = reconstruction.ReconAstra3DCone(self.scan_ctx.curr_scan)
+        self.provider = reconstruction.create_provider(self.scan_ctx.curr_scan)
 
         recon_thread = threading.Thread(target=self.__run_worker())
         recon_thread.start()
@@ -0,0 +1,60 @@
+import json
+
+import numpy as np
+import pytest
+
+from core import alignment, fsstack, phantom, scandata
+
+# Opposite cone beam projections are only approximately mirror images (different magnification), the detected shift is
+# slightly too small. On the 64 pixel phantom the error stays below 0.2 pixels
+tolerance = 0.25
+
+
+def _project(size, deg, shift):
+    return phantom.project(phantom.shepp_logan, size, size, np.deg2rad(deg), 8 * size, shift)
+
+
+@pytest.mark.parametrize("shift", [1.5, -3.25, 7.0])
+def test_find_axis_recovers_shift(shift):
+    size = 64
+    deg = np.arange(0, 360, 10.0)
+    axis = alignment.find_axis(_project(size, deg, shift), deg)
+    assert abs(axis - (size - 1) / 2 - shift) < tolerance
+
+
+def test_find_opposite_pairs_uneven_angles():
+    rng = np.random.default_rng(0)
+    deg = np.arange(0, 360, 10.0) + rng.uniform(-1, 1, 36)
+    deg = np.delete(deg, 20) # skipped projection at 200°
+    tolerance_deg = np.max(np.diff(deg))
+
+    pairs = alignment.find_opposite_pairs(deg)
+    assert len(pairs) == 4 and len(set(pairs)) == 4
+    for i, j in pairs:
+        assert deg[i] < deg[0] + 180
+        assert abs(deg[j] - deg[i] - 180) <= tolerance_deg / 2
+
+    with pytest.raises(Exception, match="scan angle too small"):
+        alignment.find_opposite_pairs(np.arange(0, 150, 10.0))
+
+
+@pytest.mark.parametrize("shift", [7.0, -5.0])
+def test_auto_axis_moves_coords_axis(tmp_path, shift):
+    size = 64
+    deg = np.arange(0, 360, 10.0)
+    projections = _project(size, deg, shift)
+    writer = fsstack.StackWriter(fsstack.get_stack_path(tmp_path, "full"), len(deg))
+    for i in range(len(deg)):
+        writer.write(i, projections[:, i, :])
+    writer.close()
+
+    scan = scandata.CTScan("test")
+    scan.path = tmp_path / "scan.json"
+    scan.reached_angles = list(deg)
+    params = scan.processing_parameters
+    params.downsample, params.downsample_mode = 2, "bin"
+
+    # Shift is returned in downsampled pixels
+    assert abs(scan.auto_axis() - shift / 2) < tolerance
+    assert abs(params.get_shift_x() - shift / 2) < tolerance
+    json.dumps(scan.to_dict()) # coords_axis stays serializable
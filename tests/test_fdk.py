@@ -0,0 +1,20 @@
+import numpy as np
+
+from core import fdk, phantom
+
+
+def test_fdk_reconstructs_phantom(tmp_path):
+    size, shift = 32, 1.5
+    source_dist = 8 * size
+    angles = np.linspace(0, 2 * np.pi, 120, endpoint=False)
+    projections = phantom.project(phantom.shepp_logan, size, size, angles, source_dist, shift)
+    truth = phantom.voxelize(phantom.shepp_logan, size, size)
+    interior = phantom.get_interior(phantom.shepp_logan, size, size)
+
+    vol = fdk.reconstruct(projections, angles, source_dist, shift, workers=2, tmp_dir=str(tmp_path))
+    err = vol[interior] - truth[interior]
+
+    # Voxels next to density edges only show the partial volume error of the sharp phantom
+    assert np.count_nonzero(interior) > 1000
+    assert abs(np.mean(err)) < 0.003
+    assert np.sqrt(np.mean(err ** 2)) < 0.01
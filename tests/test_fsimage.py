@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from core import fsimage
+
+
+def _create_images(folder, numbers, mtime):
+    for k, n in enumerate(numbers):
+        f = folder / ("P%07d.RW2" % n)
+        f.write_bytes(b"raw")
+        os.utime(str(f), (mtime + k, mtime + k))
+
+
+def test_sequence_rejects_gaps(tmp_path):
+    _create_images(tmp_path, [1000100, 1000101, 1000103, 1000104], 1000000)
+    with pytest.raises(FileNotFoundError, match="1000102 to 1000102"):
+        fsimage.find_image_sequence(tmp_path / "P1000100.RW2", 4)
+
+
+def test_sequence_rejects_next_scan_after_gap(tmp_path):
+    _create_images(tmp_path, [1000100, 1000101], 1000000)
+    _create_images(tmp_path, [1000200, 1000201], 1000010) # next scan
+    assert len(fsimage.find_image_sequence(tmp_path / "P1000100.RW2", 2)) == 2
+    with pytest.raises(FileNotFoundError, match="1000102 to 1000199"):
+        fsimage.find_image_sequence(tmp_path / "P1000100.RW2", 3)
+
+
+def test_sequence_follows_folder_rollover(tmp_path):
+    _create_images(tmp_path, [1000998, 1000999, 1010001, 1010002], 1000000) # 100_PANA -> 101_PANA
+    sequence = fsimage.find_image_sequence(tmp_path / "P1000998.RW2", 4)
+    assert [f.name for f in sequence] == ["P1000998.RW2", "P1000999.RW2", "P1010001.RW2", "P1010002.RW2"]
+
+
+def test_sequence_wraps_around_after_rollover(tmp_path):
+    _create_images(tmp_path, [9998, 9999], 1000000)
+    _create_images(tmp_path, [1, 2], 1000010) # counter restarted, taken later
+    sequence = fsimage.find_image_sequence(tmp_path / "P0009998.RW2", 4)
+    assert [f.name for f in sequence] == ["P0009998.RW2", "P0009999.RW2", "P0000001.RW2", "P0000002.RW2"]
+
+
+def test_sequence_ignores_leftovers_of_earlier_scan(tmp_path):
+    _create_images(tmp_path, [1000050, 1000051], 1000000) # earlier scan
+    _create_images(tmp_path, [1000100, 1000101, 1000102], 1000010)
+    assert len(fsimage.find_image_sequence(tmp_path / "P1000100.RW2", 3)) == 3
+
+    with pytest.raises(Exception, match="left over"):
+        fsimage.find_image_sequence(tmp_path / "P1000100.RW2", 4)
+
+
+def test_sequence_ignores_old_images_at_counter_start(tmp_path):
+    _create_images(tmp_path, [1, 2], 1000000) # earlier scan at the start of the numbering
+    _create_images(tmp_path, [9998, 9999], 1000010)
+    with pytest.raises(Exception, match="left over"):
+        fsimage.find_image_sequence(tmp_path / "P0009998.RW2", 4)
@@ -0,0 +1,37 @@
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from core import fsstack
+
+
+def _write_stack(path, arr):
+    writer = fsstack.StackWriter(path, arr.shape[1])
+    for i in range(arr.shape[1]):
+        writer.write(i, arr[:, i, :])
+    writer.close()
+
+
+def test_downsample_cache_streams_to_disk(tmp_path):
+    rng = np.random.default_rng(0)
+    arr = rng.uniform(0, 1, size=(64, 256, 64)).astype(np.float32)
+    stack_path, cache_path = tmp_path / "full.npy", tmp_path / "cache" / "full_ds2.npy"
+    _write_stack(stack_path, arr)
+    expected = fsstack.load_stack_downsample(stack_path, 2, "bin")
+    loader = lambda out_path: fsstack.load_stack_downsample(stack_path, 2, "bin", out_path=out_path)
+
+    tracemalloc.start()
+    try:
+        out = fsstack.load_cached(cache_path, {'downsample': 2}, loader)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert isinstance(out, np.memmap) and Path(out.filename) == cache_path
+    assert peak < expected.nbytes / 2 # only chunks of projections are held in memory
+    np.testing.assert_array_equal(out, expected)
+
+    out[0, 0, 0] = -1 # copy on write, the cache file stays unchanged
+    cached = fsstack.load_cached(cache_path, {'downsample': 2}, lambda out_path: None)
+    np.testing.assert_array_equal(cached, expected)
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from core import processing
+
+
+def _create_stack(img):
+    stack = processing.XRayProcessingStack()
+    stack.get_processor("limit_pre").high_limit = 0.95
+    stack.get_processor("limit_post").high_limit = 2.0
+    stack.execute(img, auto=True) # calculate normalization settings
+    return stack
+
+
+def _create_image(shape=(256, 384), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(1000, 60000, size=shape, dtype=np.uint16)
+
+
+def _peak_bytes(run):
+    run() # allocate reusable buffers before measuring
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_execution_paths_are_bit_identical():
+    img = _create_image()
+    stack = _create_stack(img)
+    expected = stack.execute(img, auto=False)
+
+    np.testing.assert_array_equal(stack.compile().execute(img), expected)
+    np.testing.assert_array_equal(stack.execute_lut(img), expected)
+    np.testing.assert_array_equal(stack.execute_cached(img, auto=False), expected)
+    np.testing.assert_array_equal(stack.execute_cached(img, auto=False), expected) # served from the stage cache
+
+    batch = np.stack([img, _create_image(seed=1)])
+    for mode in ("default", "compiled", "lut"):
+        out = stack.execute_batch(batch, mode=mode)
+        np.testing.assert_array_equal(out[0], expected)
+        np.testing.assert_array_equal(out[1], stack.execute(batch[1], auto=False))
+
+
+def test_compiled_plan_peak_memory():
+    img = _create_image()
+    stack = _create_stack(img)
+    proj_bytes = img.size * np.dtype(np.float32).itemsize
+
+    compiled = stack.compile()
+    out = np.empty(img.shape, dtype=np.float32)
+    default_peak = _peak_bytes(lambda: stack.execute(img, auto=False))
+    compiled_peak = _peak_bytes(lambda: compiled.execute(img, out=out))
+
+    assert default_peak >= proj_bytes # float32 copy of the input and temporaries of the processors
+    assert compiled_peak < proj_bytes / 100 # only small bookkeeping objects
+
+
+def test_flatfield_reloads_rebuilt_masters(tmp_path):
+    dark_path, flat_path = tmp_path / "dark.npy", tmp_path / "flat.npy"
+    np.save(str(dark_path), np.full((8, 8), 100, dtype=np.float32))
+    np.save(str(flat_path), np.full((8, 8), 1100, dtype=np.float32))
+    proc = processing.FlatFieldProc(str(dark_path), str(flat_path))
+    img = np.full((8, 8), 600, dtype=np.float32)
+    np.testing.assert_allclose(proc.process_static(img.copy()), 0.5)
+    fingerprint = proc.fingerprint()
+
+    np.save(str(flat_path), np.full((8, 8), 2100, dtype=np.float32))
+    os.utime(str(flat_path), ns=(os.stat(str(flat_path)).st_mtime_ns + 10 ** 9,) * 2)
+    np.testing.assert_allclose(proc.process_static(img.copy()), 0.25)
+    assert proc.fingerprint() != fingerprint
+
+
+def _denoise_batch(arr):
+    stack = processing.ProcessingStack().push(processing.MedianDenoiseProc(size=5, tile_size=16), "denoise_median")
+    return stack.execute_batch(arr, mode="default")
+
+
+def test_denoise_in_pool_after_serial_run():
+    rng = np.random.default_rng(0)
+    batch = rng.uniform(0, 1, size=(2, 40, 50)).astype(np.float32)
+    expected = _denoise_batch(batch) # threads are created in the parent process first
+
+    with multiprocessing.Pool(2) as pool:
+        results = pool.map_async(_denoise_batch, [batch, batch]).get(timeout=60)
+
+    for res in results:
+        np.testing.assert_array_equal(res, expected)
+    np.testing.assert_array_equal(expected[0], cv2.medianBlur(batch[0], 5))
+
+
+def test_defects_reload_rebuilt_map(tmp_path):
+    map_path = tmp_path / "defects.npy"
+    defects = np.zeros((8, 8), dtype=bool)
+    defects[2, 3] = True
+    np.save(str(map_path), defects)
+    proc = processing.DefectPixelProc(str(map_path))
+    img = np.arange(64, dtype=np.float32).reshape(8, 8)
+    assert np.count_nonzero(proc.process_static(img.copy()) != img) == 1
+
+    defects[5, 5] = True
+    np.save(str(map_path), defects)
+    os.utime(str(map_path), ns=(os.stat(str(map_path)).st_mtime_ns + 10 ** 9,) * 2)
+    assert np.count_nonzero(proc.process_static(img.copy()) != img) == 2
@@ -0,0 +1,27 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from core import processing, profiling
+
+
+@pytest.mark.parametrize("has_reset_peak", [True, False])
+def test_profiler_records_peak_memory(monkeypatch, has_reset_peak):
+    if not has_reset_peak:
+        monkeypatch.delattr(tracemalloc, "reset_peak", raising=False) # Python < 3.9
+
+    stack = processing.ProcessingStack().push(processing.LogProc(), "log")
+    profiler = profiling.StackProfiler()
+    stack.profiler = profiler
+    img = np.full((64, 64), 0.5, dtype=np.float32)
+    try:
+        out = stack.execute(img, auto=False)
+    finally:
+        profiler.stop()
+
+    np.testing.assert_array_equal(out, -np.log(img))
+    record, = profiler.records
+    assert record['stage'] == "log" and record['in_shape'] == [64, 64]
+    assert record['peak_bytes'] >= img.nbytes # -np.log allocates the output
+    assert not tracemalloc.is_tracing()
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+
+from core import fdk, phantom, reconstruction, scandata
+
+
+def test_upsample_volume_aligns_voxel_centers():
+    volume = np.arange(4, dtype=np.float32).reshape(1, 1, 4) * np.ones((2, 3, 1), dtype=np.float32)
+    out = reconstruction.upsample_volume(volume, (4, 6, 8), scale=0.5)
+
+    # Cols 0, 1, 2, 3 are centered at 0.5, 1.5, 2.5, 3.5 of 4 -> fine cols at 0.25, 0.75, ... of the coarse grid
+    expected = 0.5 * np.clip(np.arange(8) / 2.0 - 0.25, 0, 3)
+    assert out.shape == (4, 6, 8) and out.dtype == np.float32
+    np.testing.assert_allclose(out, np.broadcast_to(expected, out.shape), atol=1e-6)
+
+
+def _projected_rows(z0, z1, h, w, source_dist):
+    """
+    Detector rows (fractional) of the corners of a slab for many source positions (detector through the rotation axis)
+    """
+    angles = np.linspace(0, 2 * np.pi, 360, endpoint=False)
+    rows = []
+    for x in (-w / 2, w / 2):
+        for y in (-w / 2, w / 2):
+            depth = x * np.sin(angles) - y * np.cos(angles) # distance from the axis towards the detector
+            for z in (z0 - h / 2, z1 - h / 2):
+                rows.append(z * source_dist / (source_dist + depth) + h / 2)
+    return np.concatenate(rows)
+
+
+def test_slab_rows_contain_projected_corners():
+    h, w, source_dist = 64, 48, 100
+    for z0, z1 in [(0, 8), (20, 30), (40, 64), (31.5, 32.5)]:
+        r0, r1 = reconstruction.get_slab_rows(z0, z1, h, w, source_dist)
+        rows = _projected_rows(z0, z1, h, w, source_dist)
+        assert r0 <= max(np.min(rows), 0) and min(np.max(rows), h) <= r1
+        assert 0 <= r0 < r1 <= h
+
+
+def test_plan_slabs_covers_volume_within_budget():
+    h, num, w, source_dist = 64, 90, 48, 200
+    full = (h * num * w + h * w * w) * 4
+    for pad in (True, False):
+        for limit in (full // 2, full // 3):
+            slabs = reconstruction.plan_slabs(h, num, w, source_dist, limit, pad)
+            assert len(slabs) > 1
+            assert slabs[0][0] == 0 and slabs[-1][1] == h
+            assert all(a[1] == b[0] for a, b in zip(slabs, slabs[1:]))
+
+            for z0, z1, e0, e1, r0, r1 in slabs:
+                assert ((r1 - r0) * num * w + (e1 - e0) * w * w) * 4 <= limit
+                assert (r0, r1) == reconstruction.get_slab_rows(e0, e1, h, w, source_dist)
+                if pad:
+                    assert (e0, e1) == reconstruction.get_slab_rows(z0, z1, h, w, source_dist)
+                else:
+                    assert (e0, e1) == (z0, z1)
+
+    with pytest.raises(Exception, match="too small"):
+        reconstruction.plan_slabs(h, num, w, source_dist, full // 5, pad=True)
+
+
+def test_multires_rejects_memory_limit():
+    scan = scandata.CTScan("test")
+    scan.reconstruction_parameters.multires = [[2, 10], [1, 5]]
+    scan.reconstruction_parameters.memory_limit = 512
+    with pytest.raises(Exception, match="Memory limit"):
+        reconstruction.ReconAstra3DCone(scan).reconstruct() # raised before any projections are loaded
+
+
+@pytest.mark.parametrize("shift", [0.0, 1.5])
+def test_reconstruct_rows_fbp(tmp_path, shift):
+    size = 32
+    angles = np.linspace(0, 2 * np.pi, 120, endpoint=False)
+    # Distant source: nearly parallel beam, so rows are independent slices
+    projections = phantom.project(phantom.shepp_logan, size, size, angles, 1000 * size, shift)
+    truth = phantom.voxelize(phantom.shepp_logan, size, size)
+    interior = phantom.get_interior(phantom.shepp_logan, size, size)
+
+    vol = reconstruction.reconstruct_rows(projections, angles, shift, "FBP", 1, tmp_path, workers=2)
+    err = vol[interior] - truth[interior]
+
+    # A wrong shift sign (RMSE 0.06) or image rows running the wrong way (0.03) exceed the tolerance
+    assert abs(np.mean(err)) < 0.003
+    assert np.sqrt(np.mean(err ** 2)) < 0.01
+
+
+def _roi_scan(roi, voxel_size, downsample):
+    scan = scandata.CTScan("test")
+    scan.reconstruction_parameters.roi = roi
+    scan.reconstruction_parameters.roi_voxel_size = voxel_size
+    scan.processing_parameters.downsample = downsample
+    return reconstruction.ReconstructionProvider(scan)
+
+
+def test_get_roi_converts_to_downsampled_pixels():
+    # Region and voxel size are given in full resolution pixels, corners in any order
+    shape, window = _roi_scan([40, 4, 10, 8, 36, 30], 2.0, 2).get_roi(32, 32)
+    assert shape == (10, 16, 16)
+    np.testing.assert_allclose(window, (-12, 4, -14, 2, -11, -1))
+
+    shape, window = _roi_scan([8, 4, 10, 40, 36, 30], 1.0, 2).get_roi(32, 32)
+    assert shape == (20, 32, 32) # voxel size 0.5 downsampled pixels
+    np.testing.assert_allclose(window, (-12, 4, -14, 2, -11, -1))
+
+    assert _roi_scan(None, 1.0, 2).get_roi(32, 32) is None
+
+
+def test_fdk_roi_matches_full_reconstruction(tmp_path):
+    size, shift = 32, 1.5
+    source_dist = 8 * size
+    angles = np.linspace(0, 2 * np.pi, 60, endpoint=False)
+    projections = phantom.project(phantom.shepp_logan, size, size, angles, source_dist, shift)
+    full = fdk.reconstruct(projections, angles, source_dist, shift, workers=2, tmp_dir=str(tmp_path))
+
+    # Region at voxel size 1: the voxels coincide with voxels of the full volume
+    shape, window = _roi_scan([8, 4, 10, 40, 36, 30], 2.0, 2).get_roi(size, size)
+    roi = fdk.reconstruct(projections, angles, source_dist, shift, workers=2, tmp_dir=str(tmp_path), vol_shape=shape, window=window)
+    np.testing.assert_array_equal(roi, full[5:15, 2:18, 4:20])
@@ -0,0 +1,112 @@
+import numpy as np
+
+from core import processing, statistics
+
+
+def _create_images(num=6, shape=(32, 48), seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(2000, 50000, size=(num,) + shape, dtype=np.uint16)
+
+
+def _fill(stack, images, percentiles=None):
+    """
+    Same steps as CTScan.auto_parameters, with the projections in memory instead of collect_statistics
+    """
+    stage = statistics.get_stats_stage(stack, 0, percentiles)
+    while stage is not None:
+        if stage == 0:
+            stats = statistics.HistogramStats()
+            stats.add(images)
+        else:
+            arr = images.astype(np.float32)
+            for i in range(stage):
+                if stack.processors_enable[i]:
+                    arr = stack.processors[i].process_static(arr)
+            stats = statistics.FloatHistogramStats()
+            stats.add(arr)
+        stage = statistics.fill_stack_parameters(stack, stats, percentiles, start=stage)
+
+
+def _run_until(stack, images, name):
+    arr = images.astype(np.float32)
+    for i in range(stack.processors_name.index(name)):
+        if stack.processors_enable[i]:
+            arr = stack.processors[i].process_static(arr)
+    return arr
+
+
+def _get_max(stack):
+    return [stack.get_processor(name).max for name in ("normalize_raw", "normalize_pre", "normalize_final")]
+
+
+def test_fill_matches_auto_of_whole_scan():
+    images = _create_images()
+    stack = processing.XRayProcessingStack()
+    _fill(stack, images)
+
+    auto = processing.XRayProcessingStack()
+    auto.execute(images, auto=True)
+    np.testing.assert_allclose(_get_max(stack), _get_max(auto), rtol=1e-6)
+
+
+def test_fill_behind_flatfield(tmp_path):
+    images = _create_images()
+    rng = np.random.default_rng(1)
+    dark = rng.uniform(100, 200, images.shape[1:]).astype(np.float32)
+    flat = rng.uniform(40000, 60000, images.shape[1:]).astype(np.float32)
+    np.save(str(tmp_path / "dark.npy"), dark)
+    np.save(str(tmp_path / "flat.npy"), flat)
+
+    stacks = []
+    for _ in range(2):
+        stack = processing.XRayProcessingStack()
+        stack.get_processor("flatfield").dark_path = str(tmp_path / "dark.npy")
+        stack.get_processor("flatfield").flat_path = str(tmp_path / "flat.npy")
+        stacks.append(stack)
+    stack, auto = stacks
+
+    assert statistics.get_stats_stage(stack) == 2 # behind flatfield
+    _fill(stack, images)
+    auto.execute(images, auto=True)
+    np.testing.assert_allclose(_get_max(stack), _get_max(auto), rtol=1e-6)
+
+    _fill(stack, images, {"limit_pre": [1, 99]})
+
+    # Percentiles come from the histogram of float values (0.4% precision)
+    low, high = np.percentile(_run_until(stack, images, "limit_pre"), [1, 99])
+    limit = stack.get_processor("limit_pre")
+    np.testing.assert_allclose([limit.low_limit, limit.high_limit], [low, high], rtol=0.005)
+
+
+def test_fill_behind_defects(tmp_path):
+    images = _create_images()
+    images[:, 3, 4] = 65000 # hot pixel
+    defects = np.zeros(images.shape[1:], dtype=bool)
+    defects[3, 4] = True
+    np.save(str(tmp_path / "defects.npy"), defects)
+
+    stack = processing.XRayProcessingStack()
+    stack.get_processor("defects").map_path = str(tmp_path / "defects.npy")
+    assert statistics.get_stats_stage(stack) == 1
+    _fill(stack, images)
+    assert stack.get_processor("normalize_raw").max == np.max(np.delete(images.reshape(len(images), -1), 3 * images.shape[2] + 4, axis=1))
+
+
+def test_find_defects_ignores_saturated_pixels():
+    rng = np.random.default_rng(0)
+    frames = rng.normal(1000, 20, size=(30, 40, 40))
+    frames[:, :, 25:] = 4095 # unattenuated beam, clipped at the white level
+    frames[:, 5, 5] = 300 # dead pixel
+    frames[:, 10, 10] = 3000 # hot pixel
+    frames[:, 15, 15] += rng.normal(0, 300, size=30) # noisy pixel
+
+    stats = statistics.PixelStats()
+    for frame in frames[:12]:
+        stats.add(frame)
+    rest = statistics.PixelStats()
+    for frame in frames[12:]:
+        rest.add(frame)
+    stats.merge(rest)
+
+    defects = statistics.find_defects(stats)
+    assert np.array_equal(np.argwhere(defects), [[5, 5], [10, 10], [15, 15]])